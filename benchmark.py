@@ -0,0 +1,332 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import numpy as np
+from games.minichess import MiniChess
+from games.bitboard_minichess import BitboardMiniChess
+from mcts import MCTS, SearchStats
+from parallel_mcts import ParallelMCTS
+from models.zero import Zero
+from models.mlp import MLP
+from models.minivgg import MiniVGG
+from models.resnet import ResNet
+from models.senet import SENet
+from neural_network import NeuralNetwork
+
+GAMES = {"MiniChess": MiniChess, "BitboardMiniChess": BitboardMiniChess}
+MODELS = {"Zero": Zero, "MLP": MLP, "MiniVGG": MiniVGG, "ResNet": ResNet, "SENet": SENet}
+
+# Perft positions and the depth their node counts are recorded to.
+# Besides the initial position, they cover pinned pieces, checks, promotions and open boards.
+PERFT_POSITIONS = [
+    ("rnbqk/ppppp/5/PPPPP/RNBQK w", 5),
+    ("2r1k/pB3/1p2b/1PpNQ/R1K2 w", 4),
+    ("rN2q/p1p1p/pRPk1/3b1/2BK1 b", 4),
+    ("rNb1k/3qp/pP1Q1/K2P1/1q3 w", 4),
+    ("5/p1rbk/P3p/2qpK/1R3 b", 4),
+    ("2bk1/r2Pp/1q3/2PQK/q4 b", 4),
+    ("4k/1bq2/r3p/P1R1P/3K1 b", 4),
+]
+
+
+# Plays the same random games on a reference and a candidate game implementation,
+# checking at every position that both agree on the legal moves, the winner and the network input.
+# Returns the positions visited, as states of the reference game.
+def compare_move_generation(reference, candidate, num_games, seed=0):
+    rng = random.Random(seed)
+    positions = []
+    for game_num in range(num_games):
+        s, state_map = reference.get_initial_state()
+        t, candidate_state_map = candidate.get_initial_state()
+        w = None
+        ply = 0
+        while w is None:
+            expected = reference.get_available_actions(s)
+            actual = candidate.get_available_actions(t)
+            assert np.array_equal(expected, actual), "Legal moves differ in game {} at ply {}".format(game_num, ply)
+            assert np.array_equal(np.flatnonzero(expected), candidate.get_available_action_indices(t)), "Action indices differ in game {} at ply {}".format(game_num, ply)
+            assert np.array_equal(reference.get_tensor(s), candidate.get_tensor(t)), "States differ in game {} at ply {}".format(game_num, ply)
+            w = reference.check_winner(s, state_map)
+            assert w == candidate.check_winner(t, candidate_state_map), "Winners differ in game {} at ply {}".format(game_num, ply)
+            positions.append(s)
+            if w is None:
+                idx = np.stack(np.where(expected)).T
+                template = np.zeros_like(expected)
+                template[tuple(idx[rng.randrange(len(idx))])] = True
+                s, state_map = reference.take_action(s, state_map, template)
+                t, candidate_state_map = candidate.take_action(t, candidate_state_map, template)
+                ply += 1
+    return positions
+
+
+# Measures legal move generation throughput of a game over the given states.
+# The position cache is bypassed, so every position is generated from scratch.
+# Returns (positions per second, legal moves per second).
+def move_generation_speed(game, states, min_time=1.):
+    count, moves = 0, 0
+    start = time.time()
+    while time.time()-start < min_time:
+        for s in states:
+            moves += len(game.compute_status(s).actions)
+        count += len(states)
+    elapsed = time.time()-start
+    return count/elapsed, moves/elapsed
+
+
+# Counts the leaf nodes of the game tree below state s at the given depth.
+# Positions without legal moves have no children. Repetitions are not checked.
+def perft(game, s, state_map, depth):
+    if depth == 0:
+        return 1
+    actions = game.get_available_action_indices(s)
+    if depth == 1:
+        return len(actions)
+    return sum(perft(game, *game.take_action_index(s, state_map, a), depth-1) for a in actions)
+
+
+# Plays random games and returns every non-terminal (state, state_map) pair reached.
+def random_positions(game, num_games, seed=0):
+    rng = random.Random(seed)
+    positions = []
+    for _ in range(num_games):
+        s, state_map = game.get_initial_state()
+        while game.check_winner(s, state_map) is None:
+            positions.append((s, state_map))
+            actions = game.get_available_action_indices(s)
+            s, state_map = game.take_action_index(s, state_map, actions[rng.randrange(len(actions))])
+    return positions
+
+
+# Measures calls per second of each move generation entry point over the given positions.
+# Each position plays its first legal move for take_action.
+def engine_throughput(game, positions, min_time=1.):
+    actions = [game.get_available_action_indices(s)[0] for s, _ in positions]
+    templates = []
+    for (s, _), a in zip(positions, actions):
+        template = np.zeros_like(game.get_available_actions(s))
+        template.flat[a] = True
+        templates.append(template)
+    entry_points = [
+        ("get_available_actions", lambda: [game.get_available_actions(s) for s, _ in positions]),
+        ("get_available_action_indices", lambda: [game.get_available_action_indices(s) for s, _ in positions]),
+        ("take_action", lambda: [game.take_action(s, state_map, a) for (s, state_map), a in zip(positions, templates)]),
+        ("take_action_index", lambda: [game.take_action_index(s, state_map, a) for (s, state_map), a in zip(positions, actions)]),
+        ("in_check", lambda: [game.in_check(game.get_player(s), s) for s, _ in positions]),
+        ("check_winner", lambda: [game.check_winner(s, state_map) for s, state_map in positions]),
+    ]
+    results = {}
+    for name, run in entry_points:
+        count = 0
+        start = time.time()
+        while time.time()-start < min_time:
+            run()
+            count += len(positions)
+        results[name] = count/(time.time()-start)
+    return results
+
+
+# Runs perft on the stored positions and times each engine entry point.
+# With --save the results become the new baseline; with --check node counts must match the
+# baseline exactly and throughput is reported relative to it.
+def engine(args):
+    game = GAMES[args.game](cache_size=0) # measure move generation, not cache hits
+    results = {"game": args.game, "perft": {}, "perft_nodes_per_sec": None, "throughput": {}}
+    nodes, elapsed = 0, 0.
+    for fen, depth in PERFT_POSITIONS:
+        depth = depth if args.depth is None else min(depth, args.depth)
+        s, state_map = game.from_fen(fen)
+        counts = []
+        for d in range(1, depth+1):
+            start = time.time()
+            counts.append(perft(game, s, state_map, d))
+            elapsed += time.time()-start
+            nodes += counts[-1]
+        results["perft"][fen] = counts
+        print("{:<30} {}".format(fen, " ".join(str(c) for c in counts)))
+    results["perft_nodes_per_sec"] = nodes/elapsed
+    print("perft: {:.0f} nodes/s".format(results["perft_nodes_per_sec"]))
+
+    positions = random_positions(game, args.games, seed=args.seed)
+    results["throughput"] = engine_throughput(game, positions)
+    for name, calls_per_sec in results["throughput"].items():
+        print("{:<30} {:>12.0f} positions/s".format(name, calls_per_sec))
+
+    if args.check is not None:
+        with open(args.check, "r") as f:
+            baseline = json.loads(f.read())
+        failed = False
+        for fen, counts in results["perft"].items():
+            expected = baseline["perft"][fen][:len(counts)]
+            if counts != expected:
+                print("Node count mismatch for {}: expected {}, got {}".format(fen, expected, counts))
+                failed = True
+        print("Throughput relative to baseline:")
+        for name, calls_per_sec in [("perft", results["perft_nodes_per_sec"])] + list(results["throughput"].items()):
+            reference = baseline["perft_nodes_per_sec"] if name == "perft" else baseline["throughput"][name]
+            print("{:<30} {:>6.2f}x".format(name, calls_per_sec/reference))
+        if failed:
+            sys.exit(1)
+        print("Node counts match the baseline")
+
+    if args.save is not None:
+        directory = os.path.dirname(args.save)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(args.save, "w") as f:
+            f.write(json.dumps(results, indent=4))
+
+
+def movegen(args):
+    reference, candidate = MiniChess(), BitboardMiniChess()
+    positions = compare_move_generation(reference, candidate, args.games, seed=args.seed)
+    print("Differential test passed on {} positions from {} games".format(len(positions), args.games))
+
+    sample = random.Random(args.seed).sample(positions, min(args.sample, len(positions)))
+    results = []
+    for game, states in [(reference, sample), (candidate, [candidate.from_tensor(s) for s in sample])]:
+        positions_per_sec, moves_per_sec = move_generation_speed(game, states)
+        results.append(moves_per_sec)
+        print("{:<20} {:>12.0f} positions/s {:>12.0f} legal moves/s".format(
+            game.__class__.__name__, positions_per_sec, moves_per_sec))
+    print("Speedup: {:.1f}x".format(results[1]/results[0]))
+
+    # The batched generator is checked against the bitboard one on every position, then timed on all of them at once.
+    batch = np.stack(positions)
+    expected = np.stack([candidate.get_available_actions(candidate.from_tensor(s)).reshape(-1) for s in positions])
+    start = time.time()
+    masks = reference.get_available_actions_batch(batch)
+    elapsed = time.time()-start
+    assert np.array_equal(masks, expected), "Batched legal moves differ"
+    print("{:<20} {:>12.0f} positions/s {:>12.0f} legal moves/s".format(
+        "MiniChess (batched)", len(batch)/elapsed, masks.sum()/elapsed))
+
+
+# Times MCTS.search from the initial position for each leaf batch size, with a freshly initialized network.
+# With --stats, the instrumented numbers of each search are printed too (timing adds some overhead).
+def mcts(args):
+    game = GAMES[args.game]()
+    nn = NeuralNetwork(game, Zero)
+    s, state_map = game.get_initial_state()
+    baseline = None
+    for batch_size in args.batch_sizes:
+        stats = SearchStats() if args.stats else None
+        tree = MCTS(game, nn, stats=stats)
+        start = time.time()
+        tree.search(s, state_map, args.simulations, cpuct=args.cpuct, batch_size=batch_size)
+        sims_per_sec = args.simulations/(time.time()-start)
+        baseline = sims_per_sec if baseline is None else baseline
+        print("batch size {:>3} {:>10.0f} simulations/s {:>6.2f}x {:>8} nodes".format(
+            batch_size, sims_per_sec, sims_per_sec/baseline, tree.pool.num_nodes))
+        if stats is not None:
+            print(stats)
+
+
+# Times ParallelMCTS.search from the initial position for each worker count, with a freshly initialized network.
+# Workers are started and warmed up before timing. Speedups are relative to the first worker count.
+def parallel(args):
+    game = GAMES[args.game]()
+    nn = NeuralNetwork(game, Zero)
+    s, state_map = game.get_initial_state()
+    baseline = None
+    for workers in args.workers:
+        tree = ParallelMCTS(game, nn, num_workers=workers, max_nodes=args.max_nodes)
+        tree.search(s, state_map, workers, cpuct=args.cpuct)
+        tree.clear()
+        start = time.time()
+        tree.search(s, state_map, args.simulations, cpuct=args.cpuct, batch_size=args.batch_size)
+        sims_per_sec = args.simulations/(time.time()-start)
+        baseline = sims_per_sec if baseline is None else baseline
+        print("{:>3} workers {:>10.0f} simulations/s {:>6.2f}x {:>8} nodes".format(
+            workers, sims_per_sec, sims_per_sec/baseline, tree.pool.num_nodes))
+        tree.close()
+
+
+# Returns the seconds per call of run, averaged over at least min_time seconds after a warm-up call.
+def time_calls(run, min_time=1.):
+    run()
+    count, start = 0, time.time()
+    while time.time()-start < min_time:
+        run()
+        count += 1
+    return (time.time()-start)/count
+
+
+# Compares network evaluation on the eager model, its frozen TorchScript model and the frozen model
+# optimized for CPU inference (see NeuralNetwork.freeze), with freshly initialized weights and random
+# positions: milliseconds per predict call on one position, and positions per second of predict_batch
+# at each batch size. Frozen outputs are checked against the eager ones first.
+def inference(args):
+    game = GAMES[args.game]()
+    states = [s for s, _ in random_positions(game, args.games, seed=args.seed)]
+    for model_name in args.models:
+        nn = NeuralNetwork(game, MODELS[model_name])
+        try:
+            expected, _ = nn.predict_batch(states[:args.batch_sizes[-1]], padded=True)
+        except RuntimeError: # written for the inputs of another game
+            print("{}: does not accept {} inputs".format(model_name, args.game))
+            continue
+        print(model_name)
+        for mode in ["eager", "frozen", "optimized"]:
+            if mode != "eager":
+                nn.freeze(optimize=mode == "optimized")
+                probs, _ = nn.predict_batch(states[:args.batch_sizes[-1]], padded=True)
+                assert np.allclose(probs, expected, atol=1e-4), "{} {} predictions differ".format(model_name, mode)
+            latency = time_calls(lambda: nn.predict(states[0]))
+            throughputs = []
+            for batch_size in args.batch_sizes:
+                batch = states[:batch_size]
+                throughputs.append(len(batch)/time_calls(lambda: nn.predict_batch(batch)))
+            print("  {:<10} {:>7.3f} ms/call  {}".format(mode, 1000*latency,
+                "  ".join("{}: {:.0f}/s".format(b, t) for b, t in zip(args.batch_sizes, throughputs))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    movegen_parser = subparsers.add_parser("movegen", help="check BitboardMiniChess against MiniChess and compare move generation speed")
+    movegen_parser.add_argument("--games", help="number of random games to compare", type=int, default=50)
+    movegen_parser.add_argument("--sample", help="number of positions to time", type=int, default=200)
+    movegen_parser.add_argument("--seed", type=int, default=0)
+    movegen_parser.set_defaults(func=movegen)
+
+    engine_parser = subparsers.add_parser("engine", help="run perft and time each move generation entry point")
+    engine_parser.add_argument("--game", choices=sorted(GAMES), default="BitboardMiniChess")
+    engine_parser.add_argument("--depth", help="maximum perft depth", type=int, default=None)
+    engine_parser.add_argument("--games", help="number of random games to sample timing positions from", type=int, default=20)
+    engine_parser.add_argument("--seed", type=int, default=0)
+    engine_parser.add_argument("--save", help="write the results to this JSON baseline", default=None)
+    engine_parser.add_argument("--check", help="compare the results against this JSON baseline", default=None)
+    engine_parser.set_defaults(func=engine)
+
+    mcts_parser = subparsers.add_parser("mcts", help="compare MCTS simulations per second across leaf batch sizes")
+    mcts_parser.add_argument("--game", choices=sorted(GAMES), default="BitboardMiniChess")
+    mcts_parser.add_argument("--simulations", type=int, default=800)
+    mcts_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    mcts_parser.add_argument("--cpuct", type=float, default=3)
+    mcts_parser.add_argument("--stats", help="print where each search spends its time", action="store_true")
+    mcts_parser.set_defaults(func=mcts)
+
+    parallel_parser = subparsers.add_parser("parallel", help="compare tree-parallel MCTS simulations per second across worker counts")
+    parallel_parser.add_argument("--game", choices=["BitboardMiniChess"], default="BitboardMiniChess")
+    parallel_parser.add_argument("--simulations", type=int, default=2000)
+    parallel_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parallel_parser.add_argument("--batch-size", help="leaves each worker evaluates per forward pass", type=int, default=1)
+    parallel_parser.add_argument("--max-nodes", type=int, default=50000)
+    parallel_parser.add_argument("--cpuct", type=float, default=3)
+    parallel_parser.set_defaults(func=parallel)
+
+    inference_parser = subparsers.add_parser("inference", help="compare eager and frozen network latency and throughput")
+    inference_parser.add_argument("--game", choices=sorted(GAMES), default="BitboardMiniChess")
+    inference_parser.add_argument("--models", choices=sorted(MODELS), nargs="+", default=["Zero"])
+    inference_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 64, 256])
+    inference_parser.add_argument("--games", help="number of random games to sample positions from", type=int, default=20)
+    inference_parser.add_argument("--seed", type=int, default=0)
+    inference_parser.set_defaults(func=inference)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -14,12 +14,12 @@ from games.minichess import MiniChess
 
 
 # Evaluate the outcome of playing a checkpoint against an uninformed MCTS agent
-def evaluate_against_uninformed(checkpoint, game, model_class, my_sims, opponent_sims, cuda=False):
+def evaluate_against_uninformed(checkpoint, game, model_class, my_sims, opponent_sims, cuda=False, mcts_batch_size=1, mcts_max_nodes=None):
     my_model = NeuralNetwork(game, model_class, cuda=cuda)
     my_model.load(checkpoint)
     num_opponents = game.get_num_players() - 1
     uninformeds = [UninformedMCTSPlayer(game, opponent_sims) for _ in range(num_opponents)]
-    informed = DeepMCTSPlayer(game, my_model, my_sims)
+    informed = DeepMCTSPlayer(game, my_model, my_sims, batch_size=mcts_batch_size, max_nodes=mcts_max_nodes)
     scores, outcomes = play_match(game, [informed] + uninformeds, permute=True)
     score, outcome = scores[informed], outcomes[informed]
     print("Opponent strength: {}     My win rate: {} ({})".format(opponent_sims, round(score, 3), outcome))
@@ -124,10 +124,7 @@ def openings(game, model_class, cuda, a):
     checkpoints = nn.list_checkpoints()
     a = (5-int(a[1]), ord(a[0])-ord('a'), 5-int(a[3]), ord(a[2])-ord('a'))
     s, state_map = game.get_initial_state()
-    available = game.get_available_actions(s)
-    template = np.zeros_like(available)
-    template[a] = 1
-    new_s, new_state_map = game.take_action(s, state_map, template)
+    new_s, new_state_map = game.take_action_index(s, state_map, np.ravel_multi_index(a, (5, 5, 5, 5)))
     responses = defaultdict(int)
     for ckpt in checkpoints:
         nn.load(ckpt)
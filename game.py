@@ -1,18 +1,72 @@
+import numpy as np
+
 # Interface for defining a new game.
 # See the games folder for examples.
 class Game:
 
+    # Whether search trees keep the states of their nodes encoded (see encode) instead of as they are.
+    # Worth it for large states; games whose states are already small and slow to decode turn it off.
+    compact_tree_states = True
+
     # Returns an ndarray representing the initial game state.
     # Note that array values should be between 0 and 1.
     def get_initial_state(self):
         raise NotImplementedError
 
+    # Returns the ndarray that is fed to the network for state s.
+    # Games whose states are already ndarrays can return s itself.
+    def get_tensor(self, s):
+        raise NotImplementedError
+
+    # Inverse of get_tensor: converts a network input back into a state.
+    def from_tensor(self, tensor):
+        return tensor
+
+    # Returns a compact, immutable encoding of state s, used to store states in bulk
+    # (e.g. self-play training samples and checkpoints).
+    def encode(self, s):
+        return s
+
+    # Inverse of encode. key optionally gives get_hash of the state, for games that can skip recomputing it.
+    def decode(self, code, key=None):
+        return code
+
+    # Decodes a sequence of encoded states. Games can vectorize it.
+    def decode_batch(self, codes):
+        return [self.decode(code) for code in codes]
+
+    # Expands a sequence of encoded states into a stacked batch of network inputs.
+    # Equivalent to stacking get_tensor(decode(code)) for every code, but games can vectorize it.
+    def expand_encodings(self, codes):
+        return np.stack([self.get_tensor(self.decode(code)) for code in codes])
+
+    # Returns a hashable key that identifies state s.
+    # Used to index repetition tables and the nodes of the Monte Carlo tree.
+    def get_hash(self, s):
+        raise NotImplementedError
+
     # Returns a boolean ndarray of actions, where True indicates an available action
     # and False indicates an unavailable action at the current state s.
     # The shape of this action ndarray does not have to match the shape of the state.
     def get_available_actions(self, s):
         raise NotImplementedError
 
+    # Returns a sorted int16 ndarray with the flat indices of the available actions at state s,
+    # i.e. the positions of the True entries of get_available_actions(s).ravel().
+    def get_available_action_indices(self, s):
+        return np.flatnonzero(self.get_available_actions(s)).astype(np.int16)
+
+    # Returns an (N, num_actions) boolean array with the flattened get_available_actions of each of the
+    # given states, ready to mask a batch of policy logits. Games can vectorize this over the batch.
+    def get_available_actions_batch(self, states):
+        return np.stack([self.get_available_actions(s).reshape(-1) for s in states])
+
+    # Batched take_action_index: plays actions[n] in states[n].
+    # Returns the new states and the list of their repetition histories.
+    def take_action_batch(self, states, state_maps, actions):
+        results = [self.take_action_index(s, state_map, a) for s, state_map, a in zip(states, state_maps, actions)]
+        return [s for s, _ in results], [state_map for _, state_map in results]
+
     # Given the current state, evaluate if the game has ended.
     # Convention:
     # Return None if there is no winner yet.
@@ -21,6 +75,12 @@ class Game:
     def check_winner(self, s):
         raise NotImplementedError()
     
+    # Same as check_winner, but only for results that follow from state s alone (e.g. checkmate), ignoring
+    # any that depend on the history of the game (e.g. repetitions). Used by MCTS to prove values.
+    # Games that cannot tell them apart return None.
+    def get_position_winner(self, s):
+        return None
+
     # Given a state s and action a, produces a new ndarray s' which is the
     # resulting state from taking action a in state s.
     # Note that array values should be between 0 and 1.
@@ -28,6 +88,13 @@ class Game:
     def take_action(self, s, a):
         raise NotImplementedError()
 
+    # Same as take_action, but the action is given as a flat index
+    # into the ndarray returned by get_available_actions.
+    def take_action_index(self, s, state_map, a):
+        template = np.zeros_like(self.get_available_actions(s))
+        template.flat[a] = True
+        return self.take_action(s, state_map, template)
+
     # Given the current state s, return an integer indicating which player's turn it is.
     # The first player is 0, second player is 1, and so on.
     def get_player(self, s):
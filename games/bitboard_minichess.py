@@ -0,0 +1,369 @@
+import numpy as np
+import random
+import sys
+sys.path.append("..")
+from game import Game
+from games.minichess import MiniChess
+from utils.history import History
+
+# Squares are numbered 0-24 row by row, matching the (row, column) layout of the tensor
+# representation: square 5*i+j is board[:, i, j]. Bit n of a bitboard is set if square n is occupied.
+# Piece layers use the same order as the tensor: 0-5 are white P R N B Q K, 6-11 are black p r n b q k.
+PAWN, ROOK, KNIGHT, BISHOP, QUEEN, KING = range(6)
+PROMOTION_SQUARES = 0b11111 | (0b11111 << 20)
+BOARD = (1 << 25) - 1
+FILE_A = sum(1 << (5*i) for i in range(5))
+FILE_E = FILE_A << 4
+BIT_SHIFTS = np.arange(25, dtype=np.int64)
+
+def is_square(i, j):
+    return (i >= 0 and i < 5 and j >= 0 and j < 5)
+
+def step_attacks(deltas):
+    table = []
+    for sq in range(25):
+        i, j = divmod(sq, 5)
+        bb = 0
+        for (di, dj) in deltas:
+            if is_square(i+di, j+dj):
+                bb |= 1 << (5*(i+di) + j+dj)
+        table.append(bb)
+    return table
+
+# Squares reached by sliding from sq in each direction, given the occupied squares.
+def slide(sq, occupied, directions):
+    i, j = divmod(sq, 5)
+    bb = 0
+    for (di, dj) in directions:
+        k, l = i+di, j+dj
+        while is_square(k, l):
+            bb |= 1 << (5*k + l)
+            if occupied & (1 << (5*k + l)):
+                break
+            k, l = k+di, l+dj
+    return bb
+
+# Only the squares strictly inside each ray can block it, so these are the occupancy bits
+# a slider's attack set depends on. Every subset of the mask is precomputed into a lookup table.
+def sliding_tables(directions):
+    masks, tables = [], []
+    for sq in range(25):
+        i, j = divmod(sq, 5)
+        mask = 0
+        for (di, dj) in directions:
+            k, l = i+di, j+dj
+            while is_square(k+di, l+dj):
+                mask |= 1 << (5*k + l)
+                k, l = k+di, l+dj
+        table = {}
+        subset = 0
+        while True: # Carry-Rippler enumeration of all subsets of mask
+            table[subset] = slide(sq, subset, directions)
+            subset = (subset - mask) & mask
+            if subset == 0:
+                break
+        masks.append(mask)
+        tables.append(table)
+    return masks, tables
+
+ROOK_DIRECTIONS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+BISHOP_DIRECTIONS = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+KNIGHT_ATTACKS = step_attacks(list(zip([-2, -2, -1, -1, 1, 1, 2, 2], [-1, 1, -2, 2, -2, 2, -1, 1])))
+KING_ATTACKS = step_attacks(list(zip([-1, -1, -1, 0, 0, 1, 1, 1], [-1, 0, 1, -1, 1, -1, 0, 1])))
+PAWN_ATTACKS = [step_attacks([(-1, -1), (-1, 1)]), step_attacks([(1, -1), (1, 1)])] # indexed by color
+PAWN_PUSHES = [step_attacks([(-1, 0)]), step_attacks([(1, 0)])]
+# BETWEEN[a][b] holds the squares strictly between a and b if they share a line, else 0.
+BETWEEN = [[0]*25 for _ in range(25)]
+for sq in range(25):
+    for (di, dj) in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+        i, j = divmod(sq, 5)
+        passed = 0
+        while is_square(i+di, j+dj):
+            i, j = i+di, j+dj
+            BETWEEN[sq][5*i+j] = passed
+            passed |= 1 << (5*i+j)
+ROOK_MASKS, ROOK_TABLES = sliding_tables(ROOK_DIRECTIONS)
+BISHOP_MASKS, BISHOP_TABLES = sliding_tables(BISHOP_DIRECTIONS)
+
+def rook_attacks(sq, occupied):
+    return ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+
+def bishop_attacks(sq, occupied):
+    return BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+
+# Zobrist keys: one random 64-bit number per (layer, square) plus one for black to move.
+# A position's key is the XOR of the numbers for every piece on the board, so a move can update it
+# by XORing out the squares it vacates and XORing in the squares it fills. The fixed seed keeps keys
+# identical across processes.
+_zobrist_rng = random.Random(0x5EED)
+ZOBRIST = [[_zobrist_rng.getrandbits(64) for _ in range(25)] for _ in range(12)]
+ZOBRIST_BLACK = _zobrist_rng.getrandbits(64)
+
+def zobrist_key(pieces, color):
+    key = ZOBRIST_BLACK if color == 1 else 0
+    for layer in range(12):
+        for sq in squares(pieces[layer]):
+            key ^= ZOBRIST[layer][sq]
+    return key
+
+# Squares attacked by all pawns of the given color at once.
+def pawn_attacks(color, pawns):
+    if color == 0:
+        return ((pawns & ~FILE_A) >> 6) | ((pawns & ~FILE_E) >> 4)
+    return (((pawns & ~FILE_A) << 4) | ((pawns & ~FILE_E) << 6)) & BOARD
+
+# Yields the index of every set bit, lowest first.
+def squares(bb):
+    while bb:
+        lsb = bb & -bb
+        yield lsb.bit_length() - 1
+        bb ^= lsb
+
+
+# Immutable MiniChess position stored as one 25-bit integer per piece layer.
+class BitboardState:
+    __slots__ = ("pieces", "color", "occupancy", "key")
+
+    def __init__(self, pieces, color, occupancy=None, key=None):
+        self.pieces = pieces # tuple of 12 bitboards, in tensor layer order
+        self.color = color # player to move
+        if occupancy is None:
+            occupancy = (pieces[0] | pieces[1] | pieces[2] | pieces[3] | pieces[4] | pieces[5],
+                pieces[6] | pieces[7] | pieces[8] | pieces[9] | pieces[10] | pieces[11])
+        self.occupancy = occupancy # (white squares, black squares)
+        if key is None:
+            key = zobrist_key(pieces, color)
+        self.key = key # 64-bit Zobrist key
+
+    def __eq__(self, other):
+        return self.color == other.color and self.pieces == other.pieces
+
+    def __hash__(self):
+        return self.key
+
+
+# Alternate MiniChess backend. Rules and action layout are identical to MiniChess, but states are
+# BitboardStates and moves come from precomputed attack tables instead of scanning the 13x5x5 array.
+# States are only expanded to the 13x5x5 tensor when the network asks for them via get_tensor.
+class BitboardMiniChess(MiniChess):
+
+    # BitboardStates are a few hundred bytes, and replaying a move is cheaper than decoding one.
+    compact_tree_states = False
+
+    def get_initial_state(self):
+        pieces = [0]*12
+        pieces[PAWN] = 0b11111 << 15 # white pawns on the fourth row, black pawns on the second
+        pieces[6+PAWN] = 0b11111 << 5
+        for col in range(5):
+            pieces[col+1] |= 1 << (20+col)
+            pieces[6+col+1] |= 1 << col
+        s = BitboardState(tuple(pieces), 0)
+        return s, History(self.get_hash(s))
+
+    # Converts a 13x5x5 tensor state into the equivalent BitboardState.
+    def from_tensor(self, board):
+        bits = 1 << BIT_SHIFTS
+        pieces = tuple(int(bits[board[layer].reshape(-1) == 1.].sum()) for layer in range(12))
+        return BitboardState(pieces, int(board[12, 0, 0]))
+
+    def get_tensor(self, s):
+        planes = np.empty((13, 25), dtype=np.float32)
+        planes[:12] = (np.array(s.pieces, dtype=np.int64)[:, None] >> BIT_SHIFTS) & 1
+        planes[12] = s.color
+        return planes.reshape(13, 5, 5)
+
+    def encode(self, s):
+        codes = bytearray(26)
+        for layer in range(12):
+            for sq in squares(s.pieces[layer]):
+                codes[sq] = layer+1
+        codes[25] = s.color
+        return bytes(codes)
+
+    def decode(self, code, key=None):
+        pieces = [0]*12
+        white = black = 0
+        for sq in range(25):
+            if code[sq]:
+                bit = 1 << sq
+                pieces[code[sq]-1] |= bit
+                if code[sq] <= 6:
+                    white |= bit
+                else:
+                    black |= bit
+        return BitboardState(tuple(pieces), code[25], (white, black), key)
+
+    def get_hash(self, s):
+        return s.key
+
+    # Returns a bitboard of the pieces of the given color that attack square sq.
+    def attackers(self, s, sq, by_color, occupied):
+        p = s.pieces[6*by_color:6*by_color+6]
+        return ((KNIGHT_ATTACKS[sq] & p[KNIGHT])
+            | (KING_ATTACKS[sq] & p[KING])
+            | (PAWN_ATTACKS[1-by_color][sq] & p[PAWN]) # a pawn attacks sq if sq attacks it as an opposing pawn
+            | (rook_attacks(sq, occupied) & (p[ROOK] | p[QUEEN]))
+            | (bishop_attacks(sq, occupied) & (p[BISHOP] | p[QUEEN])))
+
+    # Returns the sorted action indices (25*from+to) of every move the player to move could make, ignoring check.
+    def pseudo_legal_moves(self, s):
+        color = s.color
+        own, opp = s.occupancy[color], s.occupancy[1-color]
+        occupied = own | opp
+        p = s.pieces[6*color:6*color+6]
+        moves = []
+        for sq in squares(p[PAWN]):
+            targets = (PAWN_PUSHES[color][sq] & ~occupied) | (PAWN_ATTACKS[color][sq] & opp)
+            moves.extend(25*sq+to for to in squares(targets))
+        for sq in squares(p[ROOK]):
+            moves.extend(25*sq+to for to in squares(rook_attacks(sq, occupied) & ~own))
+        for sq in squares(p[KNIGHT]):
+            moves.extend(25*sq+to for to in squares(KNIGHT_ATTACKS[sq] & ~own))
+        for sq in squares(p[BISHOP]):
+            moves.extend(25*sq+to for to in squares(bishop_attacks(sq, occupied) & ~own))
+        for sq in squares(p[QUEEN]):
+            moves.extend(25*sq+to for to in squares((rook_attacks(sq, occupied) | bishop_attacks(sq, occupied)) & ~own))
+        for sq in squares(p[KING]):
+            moves.extend(25*sq+to for to in squares(KING_ATTACKS[sq] & ~own))
+        moves.sort()
+        return moves
+
+    # Returns a bitboard of every square attacked by the given color.
+    def attack_map(self, s, color, occupied):
+        p = s.pieces[6*color:6*color+6]
+        attacked = pawn_attacks(color, p[PAWN])
+        for sq in squares(p[KNIGHT]):
+            attacked |= KNIGHT_ATTACKS[sq]
+        for sq in squares(p[ROOK] | p[QUEEN]):
+            attacked |= rook_attacks(sq, occupied)
+        for sq in squares(p[BISHOP] | p[QUEEN]):
+            attacked |= bishop_attacks(sq, occupied)
+        for sq in squares(p[KING]):
+            attacked |= KING_ATTACKS[sq]
+        return attacked
+
+    # Returns the sorted action indices (25*from+to) of every move that does not leave the mover in check.
+    # The opponent's attacked squares, the checkers and the pinned pieces are computed once per position,
+    # and every pseudo-legal target is then filtered against them instead of playing each move out.
+    def legal_moves(self, s):
+        color = s.color
+        opp_color = 1-color
+        own, opp = s.occupancy[color], s.occupancy[opp_color]
+        occupied = own | opp
+        p = s.pieces[6*color:6*color+6]
+        o = s.pieces[6*opp_color:6*opp_color+6]
+        king_sq = p[KING].bit_length()-1
+
+        # The king may not step onto an attacked square, including squares behind it on a slider's line.
+        attacked = self.attack_map(s, opp_color, occupied ^ p[KING])
+        moves = [25*king_sq+to for to in squares(KING_ATTACKS[king_sq] & ~own & ~attacked)]
+        checkers = self.attackers(s, king_sq, opp_color, occupied)
+        if checkers & (checkers-1): # double check, only the king can move
+            moves.sort()
+            return moves
+        if checkers: # single check, other pieces must capture the checker or block its line
+            target_mask = checkers | BETWEEN[king_sq][checkers.bit_length()-1]
+        else:
+            target_mask = BOARD
+
+        # A piece is pinned if it is the only piece between its king and an enemy slider on the same line.
+        # It can then only move along that line, up to and including the pinning piece.
+        pin_masks = {}
+        pinners = ((rook_attacks(king_sq, opp) & (o[ROOK] | o[QUEEN]))
+            | (bishop_attacks(king_sq, opp) & (o[BISHOP] | o[QUEEN])))
+        for pinner in squares(pinners):
+            blockers = BETWEEN[king_sq][pinner] & occupied
+            if blockers and not blockers & (blockers-1) and blockers & own:
+                pin_masks[blockers.bit_length()-1] = BETWEEN[king_sq][pinner] | (1 << pinner)
+
+        target_mask &= ~own
+        for sq in squares(p[PAWN]):
+            targets = ((PAWN_PUSHES[color][sq] & ~occupied) | (PAWN_ATTACKS[color][sq] & opp)) & target_mask
+            moves.extend(25*sq+to for to in squares(targets & pin_masks.get(sq, BOARD)))
+        for sq in squares(p[ROOK]):
+            targets = rook_attacks(sq, occupied) & target_mask
+            moves.extend(25*sq+to for to in squares(targets & pin_masks.get(sq, BOARD)))
+        for sq in squares(p[KNIGHT]):
+            if sq not in pin_masks: # a pinned knight can never stay on its line
+                moves.extend(25*sq+to for to in squares(KNIGHT_ATTACKS[sq] & target_mask))
+        for sq in squares(p[BISHOP]):
+            targets = bishop_attacks(sq, occupied) & target_mask
+            moves.extend(25*sq+to for to in squares(targets & pin_masks.get(sq, BOARD)))
+        for sq in squares(p[QUEEN]):
+            targets = (rook_attacks(sq, occupied) | bishop_attacks(sq, occupied)) & target_mask
+            moves.extend(25*sq+to for to in squares(targets & pin_masks.get(sq, BOARD)))
+        moves.sort()
+        return moves
+
+    def get_available_actions(self, s, check=True):
+        actions = np.zeros(625, dtype=bool)
+        actions[self.get_status(s).actions if check else self.pseudo_legal_moves(s)] = True
+        return actions.reshape(5, 5, 5, 5)
+
+    # States are a sequence of BitboardStates. The bitboard generator is already faster per position than
+    # the vectorized tensor version, so the batch is filled from the (cached) legal moves of each state.
+    def get_available_actions_batch(self, states):
+        masks = np.zeros((len(states), 625), dtype=bool)
+        for n, s in enumerate(states):
+            masks[n, self.get_status(s).actions] = True
+        return masks
+
+    def legal_action_indices(self, s):
+        return np.array(self.legal_moves(s), dtype=np.int16)
+
+    def in_check(self, my_color, s):
+        occupied = s.occupancy[0] | s.occupancy[1]
+        king_sq = s.pieces[6*my_color+KING].bit_length()-1
+        return self.attackers(s, king_sq, 1-my_color, occupied) != 0
+
+    # Plays the move from square frm to square to, returning the new BitboardState.
+    # The occupancy and Zobrist key are updated incrementally from those of s.
+    def make_move(self, s, frm, to):
+        color = s.color
+        from_bit, to_bit = 1 << frm, 1 << to
+        pieces = list(s.pieces)
+        own, opp = s.occupancy[color], s.occupancy[1-color]
+        key = s.key ^ ZOBRIST_BLACK
+        base = 6*color
+        layer = base
+        while not pieces[layer] & from_bit:
+            layer += 1
+        pieces[layer] ^= from_bit
+        key ^= ZOBRIST[layer][frm]
+        if layer == base+PAWN and to_bit & PROMOTION_SQUARES: # pawn promotion
+            layer = base+QUEEN
+        pieces[layer] |= to_bit
+        key ^= ZOBRIST[layer][to]
+        if opp & to_bit: # process capture
+            layer = 6-base
+            while not pieces[layer] & to_bit:
+                layer += 1
+            pieces[layer] ^= to_bit
+            key ^= ZOBRIST[layer][to]
+            opp ^= to_bit
+        own ^= from_bit | to_bit
+        occupancy = (own, opp) if color == 0 else (opp, own)
+        return BitboardState(tuple(pieces), 1-color, occupancy, key)
+
+    def take_action(self, s, state_map, a):
+        return self.take_action_index(s, state_map, int(np.argmax(a.reshape(-1))))
+
+    def take_action_index(self, s, state_map, a):
+        frm, to = divmod(int(a), 25)
+        new_s = self.make_move(s, frm, to)
+        irreversible = bool(s.pieces[6*s.color+PAWN] & (1 << frm) or s.occupancy[1-s.color] & (1 << to)) # pawn move or capture
+        return new_s, state_map.push(self.get_hash(new_s), irreversible)
+
+    # Restores the per-code loop of Game.decode_batch in place of the tensor version of MiniChess.
+    def decode_batch(self, codes):
+        return Game.decode_batch(self, codes)
+
+    # Restores the per-state loop of Game.take_action_batch in place of the tensor version of MiniChess.
+    def take_action_batch(self, states, state_maps, actions):
+        return Game.take_action_batch(self, states, state_maps, actions)
+
+    def get_player(self, s):
+        return s.color
+
+    def visualize(self, s, flip=False):
+        return super().visualize(self.get_tensor(s), flip)
@@ -2,31 +2,212 @@ import numpy as np
 import os
 import math
 import sys
+import threading
 sys.path.append("..")
+from collections import OrderedDict, namedtuple
 from game import Game
-from collections import defaultdict
 from utils.colors import Colors, Styles
+from utils.history import History
 
 layer_map = { 0: "P", 1: "R", 2: "N", 3: "B", 4: "Q", 5: "K", 6: "P", 7: "R",
         8: "N", 9: "B", 10: "Q", 11: "K"}
 
+# Piece code of every tensor layer in the compact encoding; 0 is an empty square.
+layer_codes = np.arange(1, 13, dtype=np.uint8)
+
 unicode_rep = {"P": '\u265f', "R": '\u265c', "N": '\u265e', "B": '\u265d', "Q":
         '\u265b', "K": '\u265a', "k": Colors.DARK+'\u265a', "q": Colors.DARK+'\u265b', "r": Colors.DARK+'\u265c',
         "b": Colors.DARK+'\u265d', "n": Colors.DARK+'\u265e', "p": Colors.DARK+'\u265f', " ": " "}
 
+# Legal moves and outcome of a position, independent of how it was reached.
+# actions holds the sorted legal action indices, in_check whether the player to move is in check,
+# and winner the result of check_winner if the position is checkmate, stalemate or decided by the
+# endgame tablebase, else None.
+PositionStatus = namedtuple("PositionStatus", ["actions", "in_check", "winner"])
+
+# Move geometry used by the batched move generator, indexed by square numbers 5*i+j.
+# ATTACKS[color, kind, from, to] is True if a piece of that color and kind (P R N B Q K, 6 = no piece)
+# on from attacks to on an empty board, PUSHES[color, from, to] marks single pawn pushes, and
+# BETWEEN[sq, 25*from+to] is 1 if sq lies strictly between from and to on a rank, file or diagonal.
+def batch_move_tables():
+    attacks = np.zeros((2, 7, 25, 25), dtype=bool)
+    pushes = np.zeros((2, 25, 25), dtype=bool)
+    between = np.zeros((25, 625), dtype=np.float32)
+    for frm in range(25):
+        i, j = divmod(frm, 5)
+        for to in range(25):
+            k, l = divmod(to, 5)
+            di, dj = k-i, l-j
+            if to == frm:
+                continue
+            rook = di == 0 or dj == 0
+            bishop = abs(di) == abs(dj)
+            attacks[:, 1, frm, to] = rook
+            attacks[:, 2, frm, to] = sorted((abs(di), abs(dj))) == [1, 2]
+            attacks[:, 3, frm, to] = bishop
+            attacks[:, 4, frm, to] = rook or bishop
+            attacks[:, 5, frm, to] = max(abs(di), abs(dj)) == 1
+            for color, forward in [(0, -1), (1, 1)]:
+                attacks[color, 0, frm, to] = di == forward and abs(dj) == 1
+                pushes[color, frm, to] = di == forward and dj == 0
+            if rook or bishop:
+                steps = max(abs(di), abs(dj))
+                for step in range(1, steps):
+                    between[5*(i+step*di//steps)+j+step*dj//steps, 25*frm+to] = 1.
+    return attacks, pushes, between
+
+ATTACKS, PUSHES, BETWEEN = batch_move_tables()
+
+# Returns an (N, 25, 25) mask of the (from, to) pairs along which the pieces in kinds attack, for a
+# batch of boards. kinds is an (N, 25) array holding the attacking side's piece kind on each square
+# (6 where it has none), colors the attacking side and occupied an (N, 25) mask of occupied squares.
+def batch_attacks(kinds, colors, occupied):
+    blocked = (occupied.astype(np.float32) @ BETWEEN).reshape(-1, 25, 25) > 0
+    return ATTACKS[colors[:, None], kinds, np.arange(25)] & ~blocked
+
+# Returns the (N, 25) kinds of the pieces of the given colors on each square of an (N, 13, 25) batch, 6 if none.
+def batch_kinds(boards, colors):
+    rows = np.arange(len(boards))[:, None]
+    own = boards[rows, 6*colors[:, None]+np.arange(6)] # (N, 6, 25)
+    return np.where(own.any(axis=1), own.argmax(axis=1), 6)
+
+# Plays one move on every board of an (N, 13, 25) batch. actions holds flat action indices.
+# Returns the new boards and whether each move was irreversible (a capture or a pawn move).
+def batch_apply(boards, actions):
+    rows = np.arange(len(boards))
+    frm, to = np.divmod(actions, 25)
+    layers = boards[rows, :12, frm].argmax(axis=1)
+    irreversible = (layers % 6 == 0) | boards[rows, :12, to].any(axis=1)
+    new_boards = boards.copy()
+    new_boards[rows, :12, to] = 0.
+    new_boards[rows, layers, frm] = 0.
+    promoted = (layers % 6 == 0) & ((to < 5) | (to >= 20))
+    new_boards[rows, np.where(promoted, layers+4, layers), to] = 1.
+    new_boards[:, 12] = 1.-boards[:, 12]
+    return new_boards, irreversible
+
+# Returns the (N, 625) legal move masks of an (N, 13, 25) batch of boards. Every pseudo-legal move of
+# every board is generated from the geometry tables, all of them are played at once, and the moves
+# that leave the mover's king attacked are removed.
+def batch_legal_moves(boards):
+    colors = boards[:, 12, 0].astype(np.int64)
+    white, black = boards[:, :6].any(axis=1), boards[:, 6:12].any(axis=1)
+    own = np.where(colors[:, None] == 0, white, black)
+    enemy = np.where(colors[:, None] == 0, black, white)
+    kinds = batch_kinds(boards, colors)
+    pawns = (kinds == 0)[:, :, None]
+    moves = batch_attacks(kinds, colors, white | black) & ~own[:, None, :]
+    moves &= ~pawns | enemy[:, None, :] # pawns only move diagonally to capture
+    moves |= pawns & PUSHES[colors] & ~(white | black)[:, None, :]
+    moves = moves.reshape(-1, 625)
+
+    index, actions = np.nonzero(moves)
+    children, _ = batch_apply(boards[index], actions)
+    movers = colors[index]
+    occupied = children[:, :12].any(axis=1)
+    attacked = batch_attacks(batch_kinds(children, 1-movers), 1-movers, occupied).any(axis=1)
+    kings = children[np.arange(len(children)), 6*movers+5] == 1.
+    in_check = (attacked & kings).any(axis=1)
+    moves[index[in_check], actions[in_check]] = False
+    return moves
+
 class MiniChess(Game):
+
+    # cache_size bounds the number of positions whose PositionStatus is kept, see get_status.
+    # tablebase is an optional tablebase.Tablebase; positions it covers are scored exactly instead of played out.
+    def __init__(self, cache_size=32768, tablebase=None):
+        self.cache_size = cache_size
+        self.tablebase = tablebase
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # Games are pickled to be sent to worker processes (see parallel_mcts.py), which start with an empty cache.
+    def __getstate__(self):
+        return {"cache_size": self.cache_size, "tablebase": self.tablebase}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
     # Returns an ndarray representing the initial game state.
     # Note that array values should be between 0 and 1.
     def get_initial_state(self):
-        state_map = defaultdict(int)
         board = np.zeros((12+1, 5, 5), dtype=np.float32) # 5 x 5 board, one layer for each white piece, one for each black piece, one for current player
         for (layer, row) in [(0, 3), (6, 1)]: # place pawns
             board[layer, row, :] = 1
         for col in range(5):
             for player in range(2):
                 board[player*6+col+1, (1-player)*4, col] = 1
-        state_map[board.tostring] += 1
-        return board, state_map
+        return board, History(self.get_hash(board))
+
+    # Returns the state described by a FEN-style string, along with a fresh repetition history.
+    # Rows are listed from black's back rank down, e.g. "rnbqk/ppppp/5/PPPPP/RNBQK w" is the initial position.
+    def from_fen(self, fen):
+        rows, color = fen.split()
+        board = np.zeros((12+1, 5, 5), dtype=np.float32)
+        for i, row in enumerate(rows.split("/")):
+            j = 0
+            for c in row:
+                if c.isdigit():
+                    j += int(c)
+                else:
+                    board["PRNBQK".index(c.upper()) + (6 if c.islower() else 0), i, j] = 1
+                    j += 1
+        board[12, :, :] = 0 if color == "w" else 1
+        s = self.from_tensor(board)
+        return s, History(self.get_hash(s))
+
+    # Inverse of from_fen.
+    def to_fen(self, s):
+        board = self.get_tensor(s)
+        rows = []
+        for i in range(5):
+            row, empty = "", 0
+            for j in range(5):
+                layers = np.flatnonzero(board[:12, i, j])
+                if len(layers) == 0:
+                    empty += 1
+                    continue
+                if empty:
+                    row, empty = row+str(empty), 0
+                piece = layer_map[layers[0]]
+                row += piece.lower() if layers[0] >= 6 else piece
+            rows.append(row + (str(empty) if empty else ""))
+        return "/".join(rows) + (" b" if board[12, 0, 0] == 1 else " w")
+
+    # Converts a 13x5x5 tensor into a state of this game.
+    def from_tensor(self, board):
+        return board
+
+    # Returns the float32 ndarray that is fed to the network for state s.
+    def get_tensor(self, s):
+        return s
+
+    # States are encoded as 26 bytes: the piece code (tensor layer + 1, or 0 if empty) of each of
+    # the 25 squares in row order, followed by the player to move. This is 50x smaller than the tensor.
+    def encode(self, s):
+        codes = (s[:12].reshape(12, 25) * layer_codes[:, None]).sum(axis=0).astype(np.uint8)
+        return codes.tobytes() + bytes([int(s[12, 0, 0])])
+
+    def decode(self, code, key=None):
+        return self.from_tensor(self.expand_encodings([code])[0])
+
+    # States are their own network inputs, so the batch is decoded by expanding it.
+    def decode_batch(self, codes):
+        return self.expand_encodings(codes)
+
+    # Vectorized over the whole batch: each piece plane is a comparison of the square codes with the layer code.
+    def expand_encodings(self, codes):
+        codes = np.frombuffer(b"".join(codes), dtype=np.uint8).reshape(-1, 26)
+        planes = np.empty((len(codes), 13, 25), dtype=np.float32)
+        planes[:, :12] = codes[:, None, :25] == layer_codes[None, :, None]
+        planes[:, 12] = codes[:, 25:]
+        return planes.reshape(-1, 13, 5, 5)
+
+    # Returns a hashable key identifying state s, used for repetition tables and search trees.
+    def get_hash(self, s):
+        return s.tobytes()
 
     def is_square(self, i, j):
         return (i >= 0 and i < 5 and j >= 0 and j < 5)
@@ -90,7 +271,7 @@ class MiniChess(Game):
                             if actions[i,j,k,l]:
                                 template = np.zeros_like(actions)
                                 template[i,j,k,l] = True
-                                new_state, _ = self.take_action(s, defaultdict(int), template)
+                                new_state, _ = self.take_action(s, History(None), template)
                                 if self.in_check(current_color, new_state):
                                     actions[i,j,k,l] = False
 
@@ -199,22 +380,68 @@ class MiniChess(Game):
         return actions
 
 
+    # Returns the PositionStatus of s.
+    # A single MCTS expansion asks for the legal moves of the same position several times
+    # (check_winner, the expansion itself and the network's valid move mask), so statuses of the
+    # most recently used positions are kept in a bounded LRU cache keyed by position hash.
+    def get_status(self, s):
+        key = self.get_hash(s)
+        with self.cache_lock:
+            status = self.cache.get(key)
+            if status is not None:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                return status
+            self.cache_misses += 1
+        status = self.compute_status(s)
+        with self.cache_lock:
+            self.cache[key] = status
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return status
+
+    # Computes the PositionStatus of s, bypassing the cache.
+    def compute_status(self, s):
+        actions = self.legal_action_indices(s)
+        actions.flags.writeable = False # shared by every caller that hits the cache
+        current_color = self.get_player(s)
+        in_check = self.in_check(current_color, s)
+        if len(actions) > 0:
+            winner = None # if we can move, the game is not over
+            if self.tablebase is not None: # unless the tablebase already knows the result
+                result = self.tablebase.probe(self.encode(s))
+                if result is not None:
+                    winner = -1 if result[0] == 0 else (current_color if result[0] > 0 else 1-current_color)
+        elif in_check:
+            winner = 1-current_color # we cannot move, so if we are in check, we lose
+        else:
+            winner = -1 # otherwise, it's a stalemate
+        return PositionStatus(actions, in_check, winner)
+
+    # Returns the sorted legal action indices of s as an int16 array, without using the cache.
+    def legal_action_indices(self, s):
+        return np.flatnonzero(self.get_available_actions(s)).astype(np.int16)
+
+    # Returns the hit and miss counters and the occupancy of the position cache.
+    def cache_info(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": len(self.cache), "max_size": self.cache_size}
+
+    def get_available_action_indices(self, s):
+        return self.get_status(s).actions
+
     # Given the current state, evaluate if the game has ended.
     # Convention:
     # Return None if there is no winner yet.
     # Return -1 if there is a tie.
     # Otherwise return the player number that won.
     def check_winner(self, s, state_map):
-        if state_map[s.tostring()] >= 3: # threefold repetition -> draw
+        if state_map[self.get_hash(s)] >= 3: # threefold repetition -> draw
             return -1
-        current_color = int(s[12, 0, 0])
-        # check if we have a king
-        if not self.get_available_actions(s).any(): # we cannot move, so if we are in check, we lose
-            if self.in_check(current_color, s):
-                return 1-current_color
-            return -1 # otherwise, it's a stalemate
-    
-        return None # if we can move, the game is not over
+        return self.get_status(s).winner
+
+    # Checkmates, stalemates and tablebase results depend on the position only.
+    def get_position_winner(self, s):
+        return self.get_status(s).winner
 
     def get_action_tuple(self, a):
         for i in range(5):
@@ -226,10 +453,16 @@ class MiniChess(Game):
 
     # Given a state s and action a, produces a new ndarray s' which is the
     # resulting state from taking action a in state s.
+    # Kept for the one-hot action interface; take_action_index does the work.
+    def take_action(self, s, state_map, a):
+        return self.take_action_index(s, state_map, int(np.argmax(a.reshape(-1))))
+
+    # Same as take_action, with the action given as its flat index (from square, to square in 5x5x5x5 order).
     # Note that array values should be between 0 and 1.
     # Make sure this does NOT modify s in-place; return a new ndarray instead.
-    def take_action(self, s, state_map, a):
-        a = self.get_action_tuple(a)
+    def take_action_index(self, s, state_map, a):
+        frm, to = divmod(int(a), 25)
+        a = (frm // 5, frm % 5, to // 5, to % 5)
         current_color = int(s[12, 0, 0])
         new_s = s.copy()
         piece_layer = -1
@@ -244,14 +477,35 @@ class MiniChess(Game):
             new_s[piece_layer, a[2], a[3]] = 1.
             new_s[piece_layer, a[0], a[1]] = 0.
         # process capture, if it occurred
+        captured = False
         for layer2 in range((1-current_color)*6, (1-current_color)*6+6):
             if new_s[layer2, a[2], a[3]] == 1.:
                 new_s[layer2, a[2], a[3]] = 0.   
+                captured = True
         new_s[12, :, :] = (1.-new_s[12, :, :]) # switch players
-        new_state_map = state_map.copy()
-        new_state_map[new_s.tostring()] += 1
+        irreversible = captured or layer_map[piece_layer] == "P"
+        new_state_map = state_map.push(self.get_hash(new_s), irreversible)
         return new_s, new_state_map
 
+    # Vectorized over an (N, 13, 5, 5) stack of states, see batch_legal_moves.
+    # Returns an (N, 625) mask of flat action indices. States are processed in chunks to bound memory.
+    def get_available_actions_batch(self, states, chunk_size=512):
+        boards = np.asarray(states, dtype=np.float32).reshape(-1, 13, 25)
+        masks = np.zeros((len(boards), 625), dtype=bool)
+        for start in range(0, len(boards), chunk_size):
+            masks[start:start+chunk_size] = batch_legal_moves(boards[start:start+chunk_size])
+        return masks
+
+    # Batched take_action_index: plays actions[n] in states[n] for an (N, 13, 5, 5) stack of states.
+    # Returns the (N, 13, 5, 5) stack of new states and the list of their repetition histories.
+    def take_action_batch(self, states, state_maps, actions):
+        boards = np.asarray(states, dtype=np.float32).reshape(-1, 13, 25)
+        new_boards, irreversible = batch_apply(boards, np.asarray(actions, dtype=np.int64))
+        new_states = new_boards.reshape(-1, 13, 5, 5)
+        new_state_maps = [state_map.push(self.get_hash(new_s), irreversible[n])
+            for n, (new_s, state_map) in enumerate(zip(new_states, state_maps))]
+        return new_states, new_state_maps
+
     # Given the current state s, return an integer indicating which player's turn it is.
     # The first player is 0, second player is 1, and so on.
     def get_player(self, s):
@@ -0,0 +1,118 @@
+import collections
+import queue
+import threading
+import time
+import numpy as np
+from concurrent.futures import Future
+from neural_network import ragged
+
+# Local inference service: a dedicated thread owns the network and answers the predict and
+# predict_batch calls of many search threads, merging the requests that arrive close together into
+# one forward pass.
+#
+# A batch starts with the oldest waiting request and takes further ones until it holds
+# max_batch_size states or max_wait seconds have passed since it started. A single request larger
+# than max_batch_size is evaluated on its own. If the number of client threads is given, a batch
+# also closes once it holds a request from each of them, since each client waits for its answer
+# before asking again. The network's forward pass releases the GIL, so the search threads keep
+# selecting while a batch runs.
+#
+# The server has the predict interface of NeuralNetwork, so it can be handed to MCTS in its place.
+# Stop it with close before training the network again.
+class InferenceServer:
+
+    def __init__(self, nn, max_batch_size=64, max_wait=0.002, num_clients=None, latency_window=10000):
+        self.nn = nn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.num_clients = num_clients
+        self.requests = queue.Queue()
+        self.batch_sizes = collections.Counter() # states per forward pass -> number of passes
+        self.queue_depths = collections.Counter() # requests still waiting when a batch was formed -> count
+        self.latencies = collections.deque(maxlen=latency_window) # seconds from request to result, most recent
+        self.stats_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    # Same as NeuralNetwork.predict, answered by the server thread.
+    def predict(self, s):
+        ps, vs = self.predict_batch([s])
+        return ps[0], vs[0]
+
+    # Same as NeuralNetwork.predict_batch, answered by the server thread.
+    # Legal move masks not given are built here, by the calling thread.
+    def predict_batch(self, states, masks=None, padded=False):
+        states = list(states)
+        masks = self.nn.legal_masks(states) if masks is None else np.asarray(masks, dtype=bool).reshape(len(states), -1)
+        future = Future()
+        start = time.time()
+        self.requests.put((states, masks, padded, future))
+        result = future.result()
+        with self.stats_lock:
+            self.latencies.append(time.time()-start)
+        return result
+
+    # Server thread loop: forms batches of requests and evaluates them until close.
+    def serve(self):
+        pending = None # request taken from the queue that did not fit the last batch
+        closing = False
+        while not closing:
+            request = pending if pending is not None else self.requests.get()
+            pending = None
+            if request is None:
+                break
+            batch = [request]
+            size = len(request[0])
+            deadline = time.time()+self.max_wait
+            while size < self.max_batch_size and len(batch) != self.num_clients:
+                try:
+                    request = self.requests.get(timeout=max(deadline-time.time(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                if size+len(request[0]) > self.max_batch_size:
+                    pending = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+            with self.stats_lock:
+                self.batch_sizes[size] += 1
+                self.queue_depths[self.requests.qsize()] += 1
+            self.evaluate(batch)
+
+    # Evaluates the states of a batch of requests in one forward pass and hands each request its share.
+    def evaluate(self, batch):
+        states = [s for states, _, _, _ in batch for s in states]
+        try:
+            probs, vs = self.nn.predict_batch(states, np.concatenate([masks for _, masks, _, _ in batch]), padded=True)
+        except Exception as error:
+            for _, _, _, future in batch:
+                future.set_exception(error)
+            return
+        start = 0
+        for request_states, masks, padded, future in batch:
+            end = start+len(request_states)
+            future.set_result((probs[start:end] if padded else ragged(probs[start:end], masks), vs[start:end]))
+            start = end
+
+    # Returns the number of forward passes and states evaluated, histograms of batch sizes and of the
+    # queue depth seen when forming each batch, and request latency percentiles in milliseconds.
+    def stats(self):
+        with self.stats_lock:
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+            queue_depths = dict(sorted(self.queue_depths.items()))
+            latencies = np.array(self.latencies)
+        passes = sum(batch_sizes.values())
+        states = sum(size*count for size, count in batch_sizes.items())
+        percentiles = {}
+        if len(latencies) > 0:
+            percentiles = {"p{}".format(q): 1000*float(np.percentile(latencies, q)) for q in (50, 90, 99)}
+        return {"passes": passes, "states": states, "mean_batch_size": states/max(passes, 1),
+            "batch_sizes": batch_sizes, "queue_depths": queue_depths, "latency_ms": percentiles}
+
+    # Answers the requests already queued, then stops the server thread.
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
@@ -3,7 +3,9 @@ import sys
 import numpy as np
 from models.zero import Zero
 from games.minichess import MiniChess
+from games.bitboard_minichess import BitboardMiniChess
 from neural_network import NeuralNetwork
+from tablebase import Tablebase
 from trainer import Trainer
 from experiments import evaluate_against_uninformed
 
@@ -13,16 +15,21 @@ with open(sys.argv[1], "r") as f:
     config = json.loads(f.read())
 
 # Instantiate
-game = globals()[config["game"]]()
+tablebase = Tablebase(config["tablebase_dir"]) if config["tablebase_dir"] is not None else None
+game = globals()[config["game"]](cache_size=config["move_cache_size"], tablebase=tablebase)
 model_class = globals()[config["model"]]
 sims = config["num_simulations"]
 cuda = config["cuda"]
 nn = NeuralNetwork(game=game, model_class=model_class, lr=config["lr"],
-    weight_decay=config["weight_decay"], batch_size=config["batch_size"], cuda=cuda)
+    weight_decay=config["weight_decay"], batch_size=config["batch_size"], cuda=cuda, cache_size=config["eval_cache_size"])
 trainer = Trainer(game=game, nn=nn, num_simulations=sims,
 num_games=config["num_games"], num_updates=config["num_updates"], 
 buffer_size_limit=config["buffer_size_limit"], cpuct=config["cpuct"],
-num_threads=config["num_threads"])
+num_threads=config["num_threads"], mcts_batch_size=config["mcts_batch_size"],
+mcts_max_nodes=config["mcts_max_nodes"], mcts_stats=config["mcts_stats"],
+mcts_root_search=config["mcts_root_search"], gumbel_actions=config["gumbel_actions"],
+inference_batch_size=config["inference_batch_size"], inference_max_wait_ms=config["inference_max_wait_ms"],
+frozen_inference=config["frozen_inference"], self_play_quantization=config["self_play_quantization"])
 
 # Logic for resuming training
 checkpoints = nn.list_checkpoints()
@@ -47,12 +54,20 @@ while True:
         trainer.policy_iteration(verbose=config["verbose"]) # One iteration of PI
         iteration += 1
         if config["verbose"]: print("Training examples:", len(trainer.training_data))
+        if config["verbose"]: print("Move cache:", game.cache_info())
+        if config["verbose"]: print("Evaluation cache:", nn.cache_info())
+        if config["verbose"]: print("MCTS:", trainer.mcts_info)
+        if config["verbose"] and trainer.search_stats is not None: print("Search:\n" + str(trainer.search_stats))
+        if config["verbose"] and trainer.inference_info is not None: print("Inference server:", trainer.inference_info)
     
     # Save checkpoint
     nn.save(name=iteration, training_data=trainer.training_data, error_log=trainer.error_log)
+    if config["frozen_inference"]: # also export it for players that load the inference-only model
+        nn.export(name=iteration)
 
     # Evaluate how the current checkpoint performs against MCTS agents of increasing strength
     # that do no use a heursitic.
     for opponent_strength in [10, 20, 40, 80, 160]:
         evaluate_against_uninformed(checkpoint=iteration, game=game, model_class=model_class,
-            my_sims=sims, opponent_sims=opponent_strength, cuda=cuda)
+            my_sims=sims, opponent_sims=opponent_strength, cuda=cuda, mcts_batch_size=config["mcts_batch_size"],
+            mcts_max_nodes=config["mcts_max_nodes"])
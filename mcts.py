@@ -1,74 +1,727 @@
 import math
 import numpy as np
-from collections import defaultdict
 import sys
+import time
 
 # Concerns: Add epsilon amount to UCB evaluation to ensure probability is considered
 # Caveat: Q in heuristic might obviate this.
 # Concerns: No Dir noise being added. If it is added, tests would break.
 # Caveat: Make Dir a switch, write tests that use Dir with fixed seed.
 
+# Value of an unsolved edge or node in NodePool.proofs and NodePool.results.
+UNPROVEN = np.iinfo(np.int16).max
+
+
+# Growable struct-of-arrays storage for the nodes of a search tree.
+# Node n owns the contiguous edges first[n] .. first[n]+num[n]-1, one per legal action, each holding
+# the action index, visit count N, total value W and prior P. visits[n] is the sum of N over the
+# edges of node n, players[n] the player to move and values[n] the network's value estimate for that
+# player when the node was expanded. Arrays are preallocated and double in size when full.
+# Once an edge has led to an expanded node, children holds that node's id (else -1) and irreversible
+# whether the move cut the repetition history, so later simulations can step to the stored state
+# directly. keys holds the hash of every node and states its state. With Game.compact_tree_states, states
+# are kept in codes in the compact encoding of Game.encode and decoded again on access.
+# proofs and results hold the game-theoretic values found by the solver (see MCTS.prove) for the player
+# moving along an edge and the player to move at a node, encoded as in the endgame tablebases:
+# n > 0 wins in n plies, -(n+1) loses in n plies, 0 draws, and UNPROVEN if not known yet.
+class NodePool():
+
+    def __init__(self, game, node_capacity=1024, edge_capacity=16384):
+        self.game = game
+        self.min_node_capacity = node_capacity
+        self.min_edge_capacity = edge_capacity
+        self.allocate(node_capacity, edge_capacity)
+        self.keys = []
+        self.codes = []
+        self.states = EncodedStates(self) if game.compact_tree_states else []
+        self.num_nodes = 0
+        self.num_edges = 0
+
+    # Replaces the pool arrays with empty ones of the given capacities.
+    def allocate(self, node_capacity, edge_capacity):
+        self.first = np.zeros(node_capacity, dtype=np.int32)
+        self.num = np.zeros(node_capacity, dtype=np.int16)
+        self.visits = np.zeros(node_capacity, dtype=np.int32)
+        self.players = np.zeros(node_capacity, dtype=np.int8)
+        self.results = np.full(node_capacity, UNPROVEN, dtype=np.int16)
+        self.values = np.zeros(node_capacity, dtype=np.float32)
+        self.actions = np.zeros(edge_capacity, dtype=np.int16)
+        self.N = np.zeros(edge_capacity, dtype=np.int32)
+        self.W = np.zeros(edge_capacity, dtype=np.float32)
+        self.P = np.zeros(edge_capacity, dtype=np.float32)
+        self.children = np.full(edge_capacity, -1, dtype=np.int32)
+        self.irreversible = np.zeros(edge_capacity, dtype=bool)
+        self.proofs = np.full(edge_capacity, UNPROVEN, dtype=np.int16)
+
+    # Adds a node with one unvisited edge per action and returns its id.
+    def add(self, key, s, player, actions, priors, value):
+        node, start, end = self.num_nodes, self.num_edges, self.num_edges+len(actions)
+        if node == len(self.first):
+            self.first, self.num, self.visits, self.players, self.results, self.values = [grow(array, node+1)
+                for array in (self.first, self.num, self.visits, self.players, self.results, self.values)]
+        if end > len(self.actions):
+            self.actions, self.N, self.W, self.P, self.children, self.irreversible, self.proofs = [grow(array, end)
+                for array in (self.actions, self.N, self.W, self.P, self.children, self.irreversible, self.proofs)]
+        self.first[node], self.num[node], self.visits[node], self.players[node] = start, len(actions), 0, player
+        self.results[node] = UNPROVEN
+        self.values[node] = value
+        self.actions[start:end] = actions
+        self.N[start:end] = 0
+        self.W[start:end] = 0
+        self.P[start:end] = priors
+        self.children[start:end] = -1
+        self.irreversible[start:end] = False
+        self.proofs[start:end] = UNPROVEN
+        self.keys.append(key)
+        if self.game.compact_tree_states:
+            self.codes.append(self.game.encode(s))
+        else:
+            self.states.append(s)
+        self.num_nodes, self.num_edges = node+1, end
+        return node
+
+    # Returns the slice of the edge arrays that belongs to node.
+    def edges(self, node):
+        start = int(self.first[node])
+        return slice(start, start+int(self.num[node]))
+
+    # Returns a mask over the nodes of those reachable from root through children links, root included.
+    # If allowed is given, the walk only passes through nodes in that mask.
+    def reachable(self, root, allowed=None):
+        keep = np.zeros(self.num_nodes, dtype=bool)
+        keep[root] = True
+        frontier = np.array([root])
+        while len(frontier) > 0:
+            children = self.children[edge_ranges(self.first[frontier], self.num[frontier])]
+            children = np.unique(children[children >= 0])
+            frontier = children[~keep[children]]
+            if allowed is not None:
+                frontier = frontier[allowed[frontier]]
+            keep[frontier] = True
+        return keep
+
+    # Drops every node not in the keep mask and renumbers the rest in their original order,
+    # packing their edges into freshly allocated arrays with room to double.
+    # Links to dropped nodes become -1. Returns the array mapping old node ids to new ones (-1 if dropped).
+    def compact(self, keep):
+        old_ids = np.flatnonzero(keep[:self.num_nodes])
+        mapping = np.full(self.num_nodes, -1, dtype=np.int32)
+        mapping[old_ids] = np.arange(len(old_ids))
+        counts = self.num[old_ids]
+        edge_ids = edge_ranges(self.first[old_ids], counts)
+        old = self.__dict__.copy()
+        self.allocate(max(self.min_node_capacity, 2*len(old_ids)), max(self.min_edge_capacity, 2*len(edge_ids)))
+        num_nodes, num_edges = len(old_ids), len(edge_ids)
+        self.first[:num_nodes] = np.cumsum(counts) - counts
+        for name in ("num", "visits", "players", "results", "values"):
+            getattr(self, name)[:num_nodes] = old[name][old_ids]
+        for name in ("actions", "N", "W", "P", "irreversible", "proofs"):
+            getattr(self, name)[:num_edges] = old[name][edge_ids]
+        children = old["children"][edge_ids]
+        self.children[:num_edges] = np.where(children >= 0, mapping[children], -1)
+        self.keys = [self.keys[i] for i in old_ids]
+        if self.game.compact_tree_states:
+            self.codes = [self.codes[i] for i in old_ids]
+        else:
+            self.states = [self.states[i] for i in old_ids]
+        self.num_nodes, self.num_edges = num_nodes, num_edges
+        return mapping
+
+    # Bytes held by the pool arrays, including unused capacity.
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.first, self.num, self.visits, self.players, self.results, self.values,
+            self.actions, self.N, self.W, self.P, self.children, self.irreversible, self.proofs))
+
+
+# Sequence view of the states of a NodePool, decoded from their codes on access.
+class EncodedStates:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getitem__(self, node):
+        return self.pool.game.decode(self.pool.codes[node], self.pool.keys[node])
+
+
+# Returns a copy of array with room for at least size entries, doubling its length.
+def grow(array, size):
+    grown = np.zeros(max(size, 2*len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+# Returns the value of a node from the proofs of its edges: the fastest win if any edge wins, otherwise
+# UNPROVEN while some edge is unproven, then a draw if any edge draws, else the slowest loss.
+def node_result(proofs):
+    wins = proofs[(proofs > 0) & (proofs != UNPROVEN)]
+    if len(wins) > 0:
+        return int(wins.min())
+    if (proofs == UNPROVEN).any():
+        return UNPROVEN
+    if (proofs == 0).any():
+        return 0
+    return int(proofs.min())
+
+
+# Returns the proof of an edge leading to a node of the opponent with the given result, one ply further away.
+def edge_proof(result):
+    if result > 0:
+        return -result-2
+    return -result
+
+
+# Returns the concatenated edge indices start[k] .. start[k]+count[k]-1 of several nodes.
+def edge_ranges(starts, counts):
+    counts = counts.astype(np.int64)
+    offsets = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(offsets, counts) + np.repeat(starts.astype(np.int64), counts)
+
+
+# Optional instrumentation of an MCTS: counts searches, simulations, selections (with their depth),
+# expansions and leaves known without evaluation (finished games and solved nodes), tracks the largest
+# tree, and times move generation, take_action, check_winner and network evaluations separately.
+# attach wraps the methods of a tree in place, so trees without stats run the plain code. One object can be
+# attached to several trees in turn (e.g. one per game) to add up their numbers; merge adds another one's.
+class SearchStats():
+
+    TIMED = ("movegen", "take_action", "check_winner", "nn")
+
+    def __init__(self):
+        self.searches = 0
+        self.simulations = 0
+        self.selections = 0
+        self.expansions = 0
+        self.terminal_hits = 0
+        self.total_depth = 0
+        self.max_depth = 0
+        self.max_tree_size = 0
+        self.search_time = 0.
+        self.times = dict.fromkeys(self.TIMED, 0.)
+        self.calls = dict.fromkeys(self.TIMED, 0)
+
+    # Instruments tree: its game and network are replaced by timing proxies and its search, gumbel_search,
+    # select, leaf_value and expand methods by counting wrappers.
+    def attach(self, tree):
+        tree.game = Timed(tree.game, {"get_available_actions": "movegen", "get_available_action_indices": "movegen",
+            "take_action": "take_action", "take_action_index": "take_action", "check_winner": "check_winner"}, self)
+        tree.nn = Timed(tree.nn, {"predict": "nn", "predict_batch": "nn"}, self)
+        select, leaf_value, expand = tree.select, tree.leaf_value, tree.expand
+
+        def counted_search(search):
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                done = search(*args, **kwargs)
+                self.search_time += time.time()-start
+                self.searches += 1
+                self.simulations += done
+                return done
+            return wrapper
+
+        def counted_select(*args, **kwargs):
+            result = select(*args, **kwargs)
+            self.selections += 1
+            self.total_depth += len(result[0])
+            self.max_depth = max(self.max_depth, len(result[0]))
+            return result
+
+        def counted_leaf_value(*args, **kwargs):
+            known = leaf_value(*args, **kwargs)
+            self.terminal_hits += known is not None
+            return known
+
+        def counted_expand(*args, **kwargs):
+            player = expand(*args, **kwargs)
+            self.expansions += 1
+            self.max_tree_size = max(self.max_tree_size, tree.pool.num_nodes)
+            return player
+
+        tree.search, tree.gumbel_search = counted_search(tree.search), counted_search(tree.gumbel_search)
+        tree.select, tree.leaf_value, tree.expand = counted_select, counted_leaf_value, counted_expand
+
+    # Returns function wrapped to add its run time and calls to the timer called name.
+    def timed(self, name, function):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.times[name] += time.time()-start
+                self.calls[name] += 1
+        return wrapper
+
+    # Adds the numbers of other to these.
+    def merge(self, other):
+        for name in ("searches", "simulations", "selections", "expansions", "terminal_hits", "total_depth", "search_time"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.max_depth = max(self.max_depth, other.max_depth)
+        self.max_tree_size = max(self.max_tree_size, other.max_tree_size)
+        for name in self.TIMED:
+            self.times[name] += other.times[name]
+            self.calls[name] += other.calls[name]
+
+    # Returns the numbers as a dictionary, along with simulations per second, the average selection depth and
+    # the share of search time spent in each timer (the rest goes to selection and backup themselves).
+    def summary(self):
+        return {"searches": self.searches, "simulations": self.simulations, "expansions": self.expansions,
+            "terminal_hits": self.terminal_hits, "max_tree_size": self.max_tree_size,
+            "max_depth": self.max_depth, "average_depth": self.total_depth/max(self.selections, 1),
+            "search_time": self.search_time, "simulations_per_sec": self.simulations/max(self.search_time, 1e-9),
+            "times": dict(self.times), "calls": dict(self.calls),
+            "time_shares": {name: self.times[name]/max(self.search_time, 1e-9) for name in self.TIMED}}
+
+    def __str__(self):
+        summary = self.summary()
+        lines = ["{} simulations in {} searches, {:.0f} simulations/s, {} expansions, {} terminal or solved leaves".format(
+            summary["simulations"], summary["searches"], summary["simulations_per_sec"], summary["expansions"], summary["terminal_hits"]),
+            "depth {:.1f} average, {} max, tree size {} max".format(summary["average_depth"], summary["max_depth"], summary["max_tree_size"])]
+        for name in self.TIMED:
+            lines.append("{:<14} {:>9.3f}s {:>6.1f}% {:>9} calls".format(name, self.times[name], 100*summary["time_shares"][name], self.calls[name]))
+        return "\n".join(lines)
+
+
+# Stands in for target, timing the listed methods under the given SearchStats timer names.
+class Timed():
+
+    def __init__(self, target, methods, stats):
+        self.target = target
+        for method, name in methods.items():
+            setattr(self, method, stats.timed(name, getattr(target, method)))
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
 # An efficient, vectorized Monte Carlo tree search implementation.
 # Uses no loops, done completely with numpy.
+# Nodes live in a NodePool and are found by state hash, so transpositions share statistics.
 class MCTS():
 
-    def __init__(self, game, nn):
+    # max_nodes optionally bounds the size of the tree, see evict.
+    # stats is an optional SearchStats that records what the searches of this tree do.
+    def __init__(self, game, nn, max_nodes=None, evict_to=0.75, stats=None):
         self.game = game
         self.nn = nn
-        self.tree = {}
+        self.pool = NodePool(game)
+        self.nodes = {} # state hash -> node id in self.pool
+        self.root = None # hash of the state the last simulation started from
+        self.max_nodes = max_nodes
+        self.evict_to = evict_to
+        self.peak_nodes = 0
+        self.evictions = 0
+        self.evicted_nodes = 0
+        self.gumbel_action = None # move chosen by the last gumbel_search
+        self.stats = stats
+        if stats is not None:
+            stats.attach(self)
 
-    # Produces a hash-friendly representation of an ndarray.
+    # Produces a hash-friendly representation of a state.
     # This is used to index nodes in the accumulated Monte Carlo tree.
     def np_hash(self, data):
-        return data.tostring()
+        return self.game.get_hash(data)
 
     # Run a MCTS simulation starting from state s of the tree.
-    # The tree is accumulated in the self.tree dictionary.
+    # The tree is accumulated in self.pool, with self.nodes mapping states to node ids.
     # The epsilon fix prevents the U term from being 0 when unexplored (N=0).
     # With the fix, priors (P) can be factored in immediately during selection and expansion.
     # This makes the search more efficient, given there are strong priors.
     def simulate(self, s, state_map, cpuct=1, epsilon_fix=True):
+        self.enforce_budget()
+        path, s, state_map, hashed_s = self.select(s, state_map, cpuct, epsilon_fix)
+        known = self.leaf_value(path, s, state_map, hashed_s)
+        if known is not None: # Reached a terminal or solved node
+            v, winning_player = known
+        else:
+            p, v = self.nn.predict(s)
+            winning_player = self.expand(s, hashed_s, p, v, path)
+        self.backup(path, v, winning_player)
+        return v, winning_player
+
+    # Runs num_simulations simulations from state s and returns how many were run.
+    # With batch_size > 1, each pass selects up to batch_size leaves before evaluating any of them:
+    # every edge on a selected path takes a virtual loss (virtual_loss extra visits that lost), which
+    # steers the following selections down other paths. The leaves are then evaluated in one
+    # batched forward pass, and the real results replace the virtual losses during backup.
+    # A pass ends early if a selection reaches a leaf that is already waiting for evaluation.
+    # time_limit optionally caps the search in seconds (num_simulations can then be None for no cap on
+    # simulations), and early_stop ends it once the most visited move at s can no longer be overtaken,
+    # see search_over.
+    def search(self, s, state_map, num_simulations, cpuct=1, batch_size=1, virtual_loss=1, time_limit=None, early_stop=False):
+        if batch_size > 1:
+            return self.search_batched(s, state_map, num_simulations, cpuct, batch_size, virtual_loss, time_limit, early_stop)
+        limit = self.simulation_limit(num_simulations, time_limit)
+        start = time.time()
+        deadline = None if time_limit is None else start+time_limit
+        hashed_s = self.np_hash(s)
+        done = 0
+        while not self.search_over(hashed_s, done, limit, start, deadline, early_stop):
+            self.simulate(s, state_map, cpuct=cpuct)
+            done += 1
+        return done
+
+    # The batched passes of search, which also apply with a batch size of 1.
+    def search_batched(self, s, state_map, num_simulations, cpuct=1, batch_size=1, virtual_loss=1, time_limit=None, early_stop=False):
+        limit = self.simulation_limit(num_simulations, time_limit)
+        start = time.time()
+        deadline = None if time_limit is None else start+time_limit
+        hashed_s = self.np_hash(s)
+        done = 0
+        while not self.search_over(hashed_s, done, limit, start, deadline, early_stop):
+            self.enforce_budget()
+            leaves = {} # state hash -> (state, path) of the leaves awaiting evaluation
+            while done+len(leaves) < limit and len(leaves) < batch_size:
+                path, leaf, leaf_map, hashed_leaf = self.select(s, state_map, cpuct, virtual_loss=virtual_loss)
+                known = self.leaf_value(path, leaf, leaf_map, hashed_leaf)
+                if known is not None: # Terminal and solved nodes need no evaluation
+                    self.backup(path, *known, virtual_loss)
+                    done += 1
+                    if len(path) == 0: # s itself is solved
+                        break
+                elif hashed_leaf in leaves: # Collision; evaluate what we have
+                    self.backup(path, 0, None, virtual_loss, count=False)
+                    break
+                else:
+                    leaves[hashed_leaf] = (leaf, path)
+            done += self.evaluate_leaves(leaves, virtual_loss)
+        return done
+
+    # Evaluates the leaves collected by a batched pass (state hash -> (state, path)) in one forward pass,
+    # then expands and backs up each of them. Returns how many there were.
+    def evaluate_leaves(self, leaves, virtual_loss):
+        if len(leaves) > 0:
+            ps, vs = self.nn.predict_batch([leaf for leaf, _ in leaves.values()])
+            for (hashed_leaf, (leaf, path)), p, v in zip(leaves.items(), ps, vs):
+                winning_player = self.expand(leaf, hashed_leaf, p, v, path)
+                self.backup(path, v, winning_player, virtual_loss)
+        return len(leaves)
+
+    # Gumbel root search (Danihelka et al., "Policy improvement by planning with Gumbel"), which makes good
+    # use of very few simulations. The max_considered moves with the highest prior logits plus Gumbel noise
+    # are searched by sequential halving: the budget is split evenly over log2(max_considered) phases, each
+    # giving every remaining move the same number of simulations (forced at the root, PUCT below it, the
+    # simulations of a phase evaluated in one batch), after which the worse half is dropped, as scored by
+    # noisy logits plus sigma(Q), see completed_q. The best remaining move is stored in gumbel_action.
+    # It is a sample from the improved policy of get_improved_policy, so it needs no temperature.
+    # Returns the number of simulations run.
+    def gumbel_search(self, s, state_map, num_simulations, cpuct=1, max_considered=16, c_visit=50, c_scale=0.1):
+        hashed_s = self.np_hash(s)
+        done = 0
+        if self.nodes.get(hashed_s) is None:
+            self.simulate(s, state_map, cpuct) # expands the root
+            done += 1
+        root = self.nodes[hashed_s]
+        edges = self.pool.edges(root)
+        if self.pool.results[root] != UNPROVEN or edges.stop-edges.start == 1:
+            dist = self.get_distribution(s, 1)
+            self.gumbel_action = dist[np.argmax(dist[:,1]),0]
+            return done
+        logits = np.log(np.maximum(self.pool.P[edges], 1e-12))
+        noisy = logits + np.random.gumbel(size=len(logits))
+        noisy[self.pool.proofs[edges] < 0] = -np.inf # never consider moves already proven to lose
+        considered = np.argsort(-noisy)[:min(max_considered, int(np.isfinite(noisy).sum()))]
+        phases = max(1, math.ceil(math.log2(len(considered))))
+        budget = num_simulations-done
+        for phase in range(phases):
+            visits = max(1, budget//(phases*len(considered)))
+            for _ in range(visits):
+                done += self.forced_pass(s, state_map, edges.start+considered[:num_simulations-done], cpuct)
+            if done >= num_simulations:
+                break
+            if len(considered) > 1:
+                scores = noisy[considered] + self.sigma(self.completed_q(root)[considered], root, c_visit, c_scale)
+                considered = considered[np.argsort(-scores)[:math.ceil(len(considered)/2)]]
+        while done < num_simulations: # leftovers from rounding go to the finalists
+            done += self.forced_pass(s, state_map, edges.start+considered[:num_simulations-done], cpuct)
+        if self.pool.results[root] != UNPROVEN: # solved during the search
+            dist = self.get_distribution(s, 1)
+            self.gumbel_action = dist[np.argmax(dist[:,1]),0]
+            return done
+        scores = noisy[considered] + self.sigma(self.completed_q(root)[considered], root, c_visit, c_scale)
+        self.gumbel_action = int(self.pool.actions[edges.start+considered[np.argmax(scores)]])
+        return done
+
+    # Runs one simulation through each of the given root edges of s, evaluating the leaves together.
+    # Returns the number of simulations run (duplicates of a leaf already in the batch are skipped).
+    def forced_pass(self, s, state_map, root_edges, cpuct, virtual_loss=1):
+        leaves = {}
+        done = 0
+        for edge in root_edges:
+            path, leaf, leaf_map, hashed_leaf = self.select(s, state_map, cpuct, virtual_loss=virtual_loss, root_edge=int(edge))
+            known = self.leaf_value(path, leaf, leaf_map, hashed_leaf)
+            if known is not None:
+                self.backup(path, *known, virtual_loss)
+                done += 1
+            elif hashed_leaf in leaves:
+                self.backup(path, 0, None, virtual_loss, count=False)
+            else:
+                leaves[hashed_leaf] = (leaf, path)
+        return done + self.evaluate_leaves(leaves, virtual_loss)
+
+    # Returns the Q value of every edge of node for the player to move, completed for unvisited edges with
+    # the node's mixed value estimate: its network value blended with the prior-weighted Q of visited edges.
+    # Proven edges count as their result.
+    def completed_q(self, node):
+        pool = self.pool
+        edges = pool.edges(node)
+        N, P, proofs = pool.N[edges], pool.P[edges], pool.proofs[edges]
+        Q = pool.W[edges]/np.maximum(N, 1)
+        proven = proofs != UNPROVEN
+        Q[proven] = np.sign(proofs[proven])
+        visited = (N > 0) | proven
+        total = N.sum()
+        v_mix = pool.values[node]
+        if visited.any() and P[visited].sum() > 0:
+            v_mix = (v_mix + total*(P[visited]*Q[visited]).sum()/P[visited].sum())/(1+total)
+        return np.where(visited, Q, v_mix)
+
+    # Monotone transform of Q values in [-1, 1] that grows with the number of visits, so that search
+    # results outweigh the priors as they become reliable.
+    def sigma(self, q, node, c_visit, c_scale):
+        N = self.pool.N[self.pool.edges(node)]
+        return (c_visit + N.max())*c_scale*(q+1)/2
+
+    # Returns the improved policy softmax(logits + sigma(completed Q)) at state s, in the format of
+    # get_distribution. It is the training target of Gumbel search; solved positions use get_distribution.
+    def get_improved_policy(self, s, c_visit=50, c_scale=0.1):
+        node = self.nodes[self.np_hash(s)]
+        if self.pool.results[node] != UNPROVEN:
+            return self.get_distribution(s, 1)
+        edges = self.pool.edges(node)
+        logits = np.log(np.maximum(self.pool.P[edges], 1e-12)) + self.sigma(self.completed_q(node), node, c_visit, c_scale)
+        logits[self.pool.proofs[edges] < 0] = -np.inf
+        policy = np.exp(logits - logits.max())
+        stats = np.empty((len(policy), 2), dtype=np.object)
+        stats[:,0] = self.pool.actions[edges].tolist()
+        stats[:,1] = policy/policy.sum()
+        return stats
+
+    # Returns num_simulations, or infinity if it is None, which is only allowed with a time limit.
+    def simulation_limit(self, num_simulations, time_limit):
+        if num_simulations is None:
+            if time_limit is None:
+                raise ValueError("search needs num_simulations, time_limit or both")
+            return math.inf
+        return num_simulations
+
+    # Returns whether a search from the state hashed_s, started at time start, should stop after done simulations:
+    # once it reaches limit or the deadline, once the root is solved, or, with early_stop, once the most visited move at the root
+    # leads the runner-up by more than the simulations that remain. Those are estimated from the rate so far
+    # when the deadline comes first, so under a time limit the move may still change in rare cases.
+    # Early stopping waits for the first simulation of the search, so a reused subtree is searched further.
+    def search_over(self, hashed_s, done, limit, start, deadline, early_stop):
+        if done >= limit:
+            return True
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            return True
+        node = self.nodes.get(hashed_s)
+        if node is None:
+            return False
+        if self.pool.results[node] != UNPROVEN: # the solver already knows the best move
+            return True
+        if not early_stop or done == 0: # a warm-started root has no rate to estimate the remaining simulations from
+            return False
+        remaining = limit-done
+        if deadline is not None:
+            remaining = min(remaining, done/max(now-start, 1e-9)*(deadline-now))
+        edges = self.pool.edges(node)
+        N = np.where(self.pool.proofs[edges] < 0, 0, self.pool.N[edges]) # as get_distribution, which never plays a lost move
+        if len(N) == 1:
+            return True
+        second, first = np.partition(N, len(N)-2)[-2:]
+        return first-second > self.peer_factor()*remaining
+
+    # Number of searches sharing the tree, whose remaining simulations all count towards early stopping.
+    def peer_factor(self):
+        return 1
+
+    # Walks down the tree from state s, picking the edge with the best UCB score at every node,
+    # until it reaches a state without a node, a solved node or a state repeated three times.
+    # Edges proven to lose are never picked.
+    # Returns the (node, edge) pairs of the path taken and the leaf's state, repetition history and hash.
+    # A positive virtual_loss is added to every edge taken, see search. root_edge forces the first step.
+    def select(self, s, state_map, cpuct=1, epsilon_fix=True, virtual_loss=0, root_edge=None):
+        pool = self.pool
         hashed_s = self.np_hash(s) # Key for state in dictionary
+        self.root = hashed_s
+        node = self.nodes.get(hashed_s)
+        path = [] # (node, edge) of every step taken
+        while node is not None and state_map[hashed_s]<3 and pool.results[node] == UNPROVEN: # Not at leaf; select.
+            if root_edge is not None and len(path) == 0:
+                best_edge = root_edge
+            else:
+                edges = pool.edges(node)
+                N, W, P = pool.N[edges], pool.W[edges], pool.P[edges]
+                Q = W/np.maximum(N, 1)
+                U = cpuct*P*math.sqrt(pool.visits[node] + (1e-6 if epsilon_fix else 0))/(1 + N)
+                heuristic = Q + U
+                heuristic[pool.proofs[edges] < 0] = -np.inf
+                best_edge = edges.start + int(np.argmax(heuristic))
+            path.append((node, best_edge))
+            if virtual_loss:
+                self.apply_virtual_loss(node, best_edge, virtual_loss)
+            node = int(pool.children[best_edge])
+            if node >= 0: # Step to the stored child without replaying the move
+                s, hashed_s = pool.states[node], pool.keys[node]
+                state_map = state_map.push(hashed_s, pool.irreversible[best_edge])
+            else:
+                s, state_map = self.game.take_action_index(s, state_map, pool.actions[best_edge]) # Submit action to get s'
+                hashed_s = self.np_hash(s)
+                pool.irreversible[best_edge] = state_map.parent is None # push cut the history
+                node = self.nodes.get(hashed_s)
+                if node is not None:
+                    pool.children[best_edge] = node
+        return path, s, state_map, hashed_s
+
+    # Counts virtual_loss lost visits on the edge of node being explored.
+    def apply_virtual_loss(self, node, edge, virtual_loss):
+        self.pool.N[edge] += virtual_loss
+        self.pool.W[edge] -= virtual_loss
+        self.pool.visits[node] += virtual_loss
+
+    # Returns (v, winning_player) for a leaf whose value is known without evaluating it: a finished game
+    # or a solved node. Results that follow from the position alone (checkmate, stalemate, a tablebase)
+    # are proven on the last edge of path; draws by repetition depend on the path and are not.
+    # Returns None if the leaf must be evaluated.
+    def leaf_value(self, path, s, state_map, hashed_s):
+        w = self.game.check_winner(s, state_map)
+        if w is not None:
+            if len(path) > 0 and self.game.get_position_winner(s) == w:
+                mover = self.pool.players[path[-1][0]]
+                self.prove(path, 1 if w == mover else 0 if w == -1 else -2) # one ply from the end
+            return 1 if w != -1 else 0, w # Someone won, or tie
+        node = self.nodes.get(hashed_s)
+        if node is None or self.pool.results[node] == UNPROVEN:
+            return None
+        result, player = int(self.pool.results[node]), int(self.pool.players[node])
+        if len(path) > 0:
+            self.prove(path, edge_proof(result))
+        if result == 0:
+            return 0, -1
+        return 1, player if result > 0 else 1-player
+
+    # Records the proof of the last edge of path and solves the nodes above it in turn: a node is won as
+    # soon as one edge wins, and lost or drawn once all of its edges are proven.
+    def prove(self, path, proof):
+        pool = self.pool
+        for node, edge in reversed(path):
+            pool.proofs[edge] = proof
+            result = node_result(pool.proofs[pool.edges(node)])
+            if result == UNPROVEN:
+                break
+            pool.results[node] = result
+            proof = edge_proof(result)
+
+    # Adds the node for non-terminal state s, with priors p over its legal actions and value estimate v,
+    # and links it to the last edge of path. Returns the player to move in s.
+    def expand(self, s, hashed_s, p, v, path):
         current_player = self.game.get_player(s)
-        if hashed_s in self.tree and state_map[hashed_s]<3: # Not at leaf; select.
-            stats = self.tree[hashed_s]
-            N, Q, P = stats[:,1], stats[:,2], stats[:,3]
-            U = cpuct*P*math.sqrt(N.sum() + (1e-6 if epsilon_fix else 0))/(1 + N)
-            heuristic = Q + U
-            best_a_idx = np.argmax(heuristic)
-            best_a = stats[best_a_idx, 0] # Pick best action to take
-            template = np.zeros_like(self.game.get_available_actions(s)) # Submit action to get s'
-            template[tuple(best_a)] = True
-            s_prime, state_map_prime = self.game.take_action(s, state_map, template)
-            v, winning_player = self.simulate(s_prime, state_map_prime) # Forward simulate with this action
-            n, q = N[best_a_idx], Q[best_a_idx]
-            adj_v = v if current_player == winning_player else -v
-            stats[best_a_idx, 2] = (n*q+adj_v)/(n + 1)
-            stats[best_a_idx, 1] += 1
-            return v, winning_player
-
-        else: # Expand
-            w = self.game.check_winner(s, state_map)
-            if w is not None: # Reached a terminal node
-                return 1 if w != -1 else 0, w # Someone won, or tie
-            available_actions = self.game.get_available_actions(s)
-            idx = np.stack(np.where(available_actions)).T
-            p, v = self.nn.predict(s)
-            stats = np.zeros((len(idx), 4), dtype=np.object)
-            stats[:,-1] = p
-            stats[:,0] = list(idx)
-            self.tree[hashed_s] = stats
-            return v, current_player
+        idx = self.game.get_available_action_indices(s)
+        node = self.pool.add(hashed_s, s, current_player, idx, p, v)
+        self.nodes[hashed_s] = node
+        self.peak_nodes = max(self.peak_nodes, node+1)
+        if len(path) > 0:
+            self.pool.children[path[-1][1]] = node
+        return current_player
+
+    # Adds value v, won by winning_player, to every edge of path, removing any virtual loss first.
+    # With count=False the visits are not counted, which just undoes the virtual loss.
+    def backup(self, path, v, winning_player, virtual_loss=0, count=True):
+        pool = self.pool
+        for node, edge in path:
+            pool.W[edge] += (v if pool.players[node] == winning_player else -v) + virtual_loss
+            pool.N[edge] += count - virtual_loss
+            pool.visits[node] += count - virtual_loss
 
 
+    # Makes the child reached by playing action from the root the new root, keeping the statistics
+    # of its subtree as a warm start for the next search and freeing every other node.
+    # If that child was never expanded, the whole tree is freed.
+    def advance_root(self, action):
+        root = self.nodes.get(self.root)
+        child = -1
+        if root is not None:
+            edges = self.pool.edges(root)
+            edge = edges.start + np.flatnonzero(self.pool.actions[edges] == action)[0]
+            child = int(self.pool.children[edge])
+        if child < 0:
+            self.clear()
+            return
+        mapping = self.pool.compact(self.pool.reachable(child))
+        self.root = self.pool.keys[mapping[child]]
+        self.nodes = {key: node for node, key in enumerate(self.pool.keys)}
+
+    # Moves the root to state s, which may be the current root or one of its children
+    # (e.g. after an opponent's move). Frees the tree if s is neither.
+    def reroot(self, s):
+        hashed_s = self.np_hash(s)
+        if hashed_s == self.root:
+            return
+        root = self.nodes.get(self.root)
+        if root is not None:
+            edges = self.pool.edges(root)
+            for edge in range(edges.start, edges.stop):
+                child = self.pool.children[edge]
+                if child >= 0 and self.pool.keys[child] == hashed_s:
+                    self.advance_root(self.pool.actions[edge])
+                    return
+        self.clear()
+
+    # Evicts nodes once the tree holds max_nodes of them. Called between simulations (or between
+    # batched passes, so a pass can overshoot the budget by up to its batch size), since eviction
+    # renumbers the nodes that paths refer to.
+    def enforce_budget(self):
+        if self.max_nodes is not None and self.pool.num_nodes >= self.max_nodes:
+            self.evict()
+
+    # Shrinks the tree to evict_to of max_nodes by keeping the most visited nodes that are still
+    # connected to the root; everything else is freed. The visit statistics on the edges leading
+    # into an evicted subtree are kept, and the subtree is expanded again if selection returns to it.
+    def evict(self):
+        pool = self.pool
+        target = max(1, int(self.max_nodes*self.evict_to))
+        order = np.lexsort((np.arange(pool.num_nodes), pool.visits[:pool.num_nodes])) # least visited first, then oldest
+        keep = np.zeros(pool.num_nodes, dtype=bool)
+        keep[order[-target:]] = True
+        root = self.nodes.get(self.root)
+        if root is not None:
+            keep[root] = True
+            keep = pool.reachable(root, keep)
+        self.evictions += 1
+        self.evicted_nodes += int(pool.num_nodes - keep.sum())
+        pool.compact(keep)
+        self.nodes = {key: node for node, key in enumerate(pool.keys)}
+
+    # Returns the size of the tree and the eviction counters.
+    def memory_info(self):
+        return {"nodes": self.pool.num_nodes, "peak_nodes": self.peak_nodes, "max_nodes": self.max_nodes,
+            "evictions": self.evictions, "evicted_nodes": self.evicted_nodes, "bytes": self.pool.nbytes()}
+
+    # Frees every node.
+    def clear(self):
+        self.pool = NodePool(self.game, self.pool.min_node_capacity, self.pool.min_edge_capacity)
+        self.nodes = {}
+        self.root = None
+
     # Returns the MCTS policy distribution for state s.
     # The temperature parameter softens or hardens this distribution.
+    # Rows are (action index, probability) pairs, one per legal action.
+    # Moves proven to lose get no visits. If s is solved, the distribution is uniform over its best moves
+    # (the fastest wins, draws, or the slowest losses), whatever the temperature.
     def get_distribution(self, s, temperature):
-        hashed_s = self.np_hash(s)
-        stats = self.tree[hashed_s][:,:2].copy()
-        N = stats[:,1]
+        node = self.nodes[self.np_hash(s)]
+        edges = self.pool.edges(node)
+        N = self.pool.N[edges].astype(np.float64)
+        proofs = self.pool.proofs[edges]
+        if self.pool.results[node] != UNPROVEN:
+            N = (proofs == self.pool.results[node]).astype(np.float64)
+            temperature = 1
+        else:
+            N[proofs < 0] = 0
         try:
-            raised = np.power(N, 1/temperature)
+            with np.errstate(over="ignore"):
+                raised = np.power(N, 1/temperature)
+            if not np.isfinite(raised).all():
+                raise OverflowError
         # As temperature approaches 0, the effect becomes equivalent to argmax.
         except (ZeroDivisionError, OverflowError):
             raised = np.zeros_like(N)
@@ -77,10 +730,11 @@ class MCTS():
         total = raised.sum()
         # If all children are unexplored, prior is uniform.
         if total == 0:
-            raised[:] = 1
+            raised[:] = proofs >= 0
             total = raised.sum()
         dist = raised/total
+        stats = np.empty((len(dist), 2), dtype=np.object)
+        stats[:,0] = self.pool.actions[edges].tolist()
         stats[:,1] = dist
         return stats
         
-
@@ -13,23 +13,31 @@ def play_match(level, black):
     from neural_network import NeuralNetwork
     from models.zero import Zero
     from players.deep_mcts_player import DeepMCTSPlayer
-    from games.minichess import MiniChess
+    from games.bitboard_minichess import BitboardMiniChess
 
+    deep = deep1 = None # closed in finally once created
     try:
-        game = MiniChess()
+        game = BitboardMiniChess()
         ckpt = 320
         nn = NeuralNetwork(game, Zero, cuda=False)
-        nn.load(ckpt)
+        if args.quantized is not None:
+            nn.load_frozen("{}-int8-{}".format(ckpt, args.quantized))
+        elif args.frozen:
+            nn.load_frozen(ckpt)
+        else:
+            nn.load(ckpt)
 
         human =  HumanMinichessPlayer(game)
-        deep = DeepMCTSPlayer(game, nn, simulations=args.level*10)
-        deep1 = DeepMCTSPlayer(game, nn, simulations=args.level*10)
+        simulations = args.level*10 if args.move_time is None else None # a move time replaces the simulation count
+        deep = DeepMCTSPlayer(game, nn, simulations=simulations, workers=args.workers, move_time=args.move_time)
         if black:
             players = [deep, human]
             human_num = 1
         else:
+            deep1 = DeepMCTSPlayer(game, nn, simulations=simulations, workers=args.workers, move_time=args.move_time)
             players = [deep1, deep]
             human_num = 0
+        opponent = players[1-human_num]
 
         s, state_map = game.get_initial_state()
         winner = game.check_winner(s, state_map)
@@ -46,6 +54,8 @@ def play_match(level, black):
                 black_token = "\u25c9"
 
             rows[0] += "{}{}{} {}{}MiniChess-Zero (Lvl. {}){}".format(Styles.PADDING_SMALL, Colors.GREEN, white_token if black else black_token, Colors.BOLD, Colors.LIGHT, level, Colors.RESET)
+            if opponent.last_search is not None:
+                rows[1] += "{}  {}{} simulations in {:.0f} ms{}".format(Styles.PADDING_SMALL, Colors.GRAY, opponent.last_search["simulations"], 1000*opponent.last_search["elapsed"], Colors.RESET)
             rows[-3] += "{}{}{} {}{}{}{}".format(Styles.PADDING_SMALL, Colors.GREEN, black_token if black else white_token , Colors.BOLD, Colors.LIGHT, getpass.getuser(), Colors.RESET)
             os.system('clear')
             print("\n\n\n\n")
@@ -90,6 +100,11 @@ def play_match(level, black):
         print("\n\n\n\n")
         print("\n".join(rows))
 
+    finally:
+        for player in (deep, deep1):
+            if player is not None:
+                player.close()
+
 
 if __name__ == "__main__":
     import warnings
@@ -97,6 +112,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-l", "--level", help="strength of AI opponent", type=int, default=5)
     parser.add_argument("-p", "--play-as", help="color to play as", type=str, default="white")
+    parser.add_argument("-t", "--move-time", help="milliseconds the AI opponent thinks per move, instead of a number of simulations set by the level", type=int, default=None)
+    parser.add_argument("-w", "--workers", help="processes searching for the AI opponent", type=int, default=1)
+    parser.add_argument("-f", "--frozen", help="play with the exported inference-only model of the checkpoint", action="store_true")
+    parser.add_argument("-q", "--quantized", help="play with the int8 model of the checkpoint written by quantize.py", choices=["dynamic", "static"], default=None)
     args = parser.parse_args()
     
     play_match(level=args.level, black=(args.play_as=="black"))
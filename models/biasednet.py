@@ -9,7 +9,7 @@ class BiasedNet(Model):
 
 
   def forward(self, x):
-    batch_size = len(x)
+    batch_size = x.size(0)
     this_output_shape = tuple([batch_size] + list(self.output_shape))
 
     p_logits = torch.ones(this_output_shape)
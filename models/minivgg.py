@@ -19,7 +19,7 @@ class MiniVGG(Model):
     self.v_head = torch.nn.Linear(num_hidden_units, 1)
 
   def forward(self, x):
-    batch_size = len(x)
+    batch_size = x.size(0)
     this_output_shape = tuple([batch_size] + list(self.output_shape))
     x = x.permute(0,3,1,2) # NHWC -> NCHW
 
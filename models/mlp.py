@@ -18,7 +18,7 @@ class MLP(Model):
     self.v_head = torch.nn.Linear(num_hidden_units, 1)
 
   def forward(self, x):
-    batch_size = len(x)
+    batch_size = x.size(0)
     this_output_shape = tuple([batch_size] + list(self.output_shape))
 
     # Network
@@ -10,7 +10,7 @@ class PriorNet(Model):
 
 
   def forward(self, x):
-    batch_size = len(x)
+    batch_size = x.size(0)
     this_output_shape = tuple([batch_size] + list(self.output_shape))
 
     p_logits = torch.zeros(this_output_shape)
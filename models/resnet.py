@@ -90,7 +90,7 @@ class ResNet(Model):
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        batch_size = len(x)
+        batch_size = x.size(0)
         this_output_shape = tuple([batch_size] + list(self.output_shape))
         x = x.permute(0,3,1,2) # NHWC -> NCHW
 
@@ -1,15 +1,38 @@
+import copy
+import io
 import torch
 import numpy as np
 import os
+import threading
+from collections import OrderedDict
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from game import Game
+
+# Splits the rows of (N, num_actions) move probabilities into a list with the entries of each row's legal moves.
+def ragged(probs, masks):
+    return np.split(probs[masks], np.cumsum(masks.sum(axis=1))[:-1])
 
 # Object that manages interfacing data with the underlying PyTorch model, as well as checkpointing models.
 class NeuralNetwork():
 
-    def __init__(self, game, model_class, lr=1e-3, weight_decay=1e-8, batch_size=64, cuda=False):
+    # cache_size bounds the number of positions whose (policy, value) evaluation is kept, see predict_batch.
+    # 0 disables the cache.
+    def __init__(self, game, model_class, lr=1e-3, weight_decay=1e-8, batch_size=64, cuda=False, cache_size=0):
         self.game = game
         self.batch_size = batch_size
-        input_shape = game.get_initial_state()[0].shape
-        p_shape = game.get_available_actions(game.get_initial_state()[0]).shape
+        self.version = 0 # bumped whenever the weights change, so cached evaluations of older weights are never used
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.frozen = None # inference-only TorchScript copy of the weights, see freeze
+        self.unoptimized = None # TorchScript serialization of frozen before it was optimized for inference
+        initial_state = game.get_initial_state()[0]
+        input_shape = game.get_tensor(initial_state).shape
+        p_shape = game.get_available_actions(initial_state).shape
+        self.num_actions = int(np.prod(p_shape))
         self.model = model_class(input_shape, p_shape)
         self.cuda = cuda
         if self.cuda:
@@ -19,20 +42,42 @@ class NeuralNetwork():
             self.optimizer = torch.optim.Adam(self.model.parameters(), lr=lr, weight_decay=weight_decay)
 
 
-    # Incoming data is a numpy array containing (state, prob, outcome) tuples.
+    # Networks are pickled to be sent to worker processes (see parallel_mcts.py), which start with an empty cache.
+    # A frozen model travels in its TorchScript serialization. Models optimized for inference do not load back
+    # once saved, so their unoptimized form is sent instead and optimized again on arrival.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["cache"] = OrderedDict()
+        del state["cache_lock"]
+        del state["unoptimized"]
+        if self.frozen is not None:
+            state["frozen"] = (self.serialized_frozen(), self.unoptimized is not None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache_lock = threading.Lock()
+        self.unoptimized = None
+        if self.frozen is not None:
+            data, optimize = self.frozen
+            self.set_frozen(torch.jit.load(io.BytesIO(data)), optimize)
+
+    # Incoming data is a numpy array containing (encoded state, prob, outcome) tuples.
+    # States are only expanded to network inputs for the sampled batch.
     def train(self, data):
+        self.weights_changed()
         self.model.train()
         batch_size=self.batch_size
         idx = np.random.randint(len(data), size=batch_size)
         batch = data[idx]
-        states = np.stack(batch[:,0])
-        x = torch.from_numpy(states)
+        x = torch.from_numpy(self.game.expand_encodings(batch[:,0]))
+        masks = self.game.get_available_actions_batch(self.game.decode_batch(batch[:,0]))
         p_pred, v_pred = self.model(x)
         v_pred = v_pred.view(-1)
         p_gt, v_gt = batch[:,1], torch.from_numpy(batch[:,2].astype(np.float32))
         if self.cuda:
             v_gt = v_gt.cuda()
-        loss = self.loss(states, (p_pred, v_pred), (p_gt, v_gt))
+        loss = self.loss(masks, (p_pred, v_pred), (p_gt, v_gt))
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
@@ -41,50 +86,218 @@ class NeuralNetwork():
 
     # Given a single state s, does inference to produce a distribution of valid moves P and a value V.
     def predict(self, s):
-        self.model.eval()
-        input_s = np.array([s])
+        ps, vs = self.predict_batch([s])
+        return ps[0], vs[0]
+
+
+    # Batched version of predict: evaluates a sequence (or stacked array) of states in one forward pass.
+    # masks optionally holds their (N, num_actions) legal move masks, e.g. from game.get_available_actions_batch;
+    # by default they are built from each state's legal action indices.
+    # Returns a list with the distribution over each state's valid moves (ordered by flat action index),
+    # or with padded=True an (N, num_actions) array that is 0 on illegal moves, and an array of values.
+    # With a cache, states evaluated before under the current weights are answered from it, keyed by
+    # their hash and the weights version, and only the others are fed to the network.
+    # Returned distributions may be shared with the cache and must not be modified.
+    def predict_batch(self, states, masks=None, padded=False):
+        masks = self.legal_masks(states) if masks is None else np.asarray(masks, dtype=bool).reshape(len(states), -1)
+        if self.cache_size == 0:
+            probs, vs = self.evaluate_batch(states, masks)
+            return (probs if padded else ragged(probs, masks)), vs
+        version = self.version
+        keys = [(self.game.get_hash(s), version) for s in states]
+        ps, vs = [None]*len(states), np.zeros(len(states), dtype=np.float32)
+        with self.cache_lock:
+            for i, key in enumerate(keys):
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self.cache.move_to_end(key)
+                    ps[i], vs[i] = cached
+            misses = [i for i in range(len(states)) if ps[i] is None]
+            self.cache_hits += len(states)-len(misses)
+            self.cache_misses += len(misses)
+        if len(misses) > 0:
+            probs, new_vs = self.evaluate_batch([states[i] for i in misses], masks[misses])
+            with self.cache_lock:
+                for i, p, v in zip(misses, ragged(probs, masks[misses]), new_vs):
+                    ps[i], vs[i] = p, v
+                    self.cache[keys[i]] = (p, v)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        if padded:
+            probs = np.zeros(masks.shape, dtype=np.float32)
+            probs[masks] = np.concatenate(ps)
+            return probs, vs
+        return ps, vs
+
+
+    # Returns the (N, num_actions) legal move masks of states from their legal action indices.
+    def legal_masks(self, states):
+        masks = np.zeros((len(states), self.num_actions), dtype=bool)
+        for n, s in enumerate(states):
+            masks[n, self.game.get_available_action_indices(s)] = True
+        return masks
+
+
+    # Evaluates states in one forward pass, without the cache, and applies a masked softmax to the whole
+    # batch of logits at once. Returns the (N, num_actions) move probabilities and the values.
+    # Runs on the frozen model if there is one.
+    def evaluate_batch(self, states, masks):
+        model = self.frozen
+        if model is None:
+            model = self.model
+            model.eval()
+        input_s = torch.from_numpy(np.stack([self.game.get_tensor(s) for s in states]))
+        legal = torch.from_numpy(masks)
+        if self.cuda:
+            input_s, legal = input_s.cuda(), legal.cuda()
+        with torch.inference_mode():
+            p_logits, v = model(input_s)
+            p_logits = p_logits.reshape(len(states), -1).masked_fill(~legal, -np.inf)
+            probs = torch.exp(torch.nn.functional.log_softmax(p_logits, dim=1))
+            probs = probs.masked_fill(~legal, 0).cpu().numpy() # rows without legal moves are all 0, not NaN
+            v = v.cpu().numpy().reshape(-1)
+        return probs, v
+
+
+    # Starts a new weights version and drops the cached evaluations and the frozen model of the old one.
+    def weights_changed(self):
+        self.evaluator_changed()
+        self.frozen = None
+        self.unoptimized = None
+
+
+    # Starts a new cache version, for when the model predictions run on changes.
+    def evaluator_changed(self):
+        with self.cache_lock:
+            self.version += 1
+            self.cache.clear()
+
+
+    # Builds an inference-only TorchScript model of the current weights and predicts with it until they change.
+    # The model is traced in eval mode (no dropout, batch norm on its running statistics) on a batch of
+    # initial states and frozen, which inlines the weights as constants and folds batch norm into the
+    # preceding convolutions. With optimize, it is also rewritten for CPU inference (MKLDNN layouts), which
+    # pays off on large batches but slows single positions down, see set_frozen.
+    # Models must keep the batch size dynamic (x.size(0), not len(x)) to be traced.
+    def freeze(self, optimize=False):
+        model = self.model.module if self.cuda else self.model
+        self.set_frozen(self.trace(model), optimize)
+        return self.frozen
+
+
+    # Predicts with the TorchScript model frozen from now on. With optimize, it is first rewritten for CPU
+    # inference. The rewritten model does not load back once saved (and the rewrite changes frozen in place),
+    # so frozen is serialized beforehand for export and pickling.
+    def set_frozen(self, frozen, optimize=False):
+        self.evaluator_changed()
+        self.unoptimized = None
+        if optimize:
+            buffer = io.BytesIO()
+            torch.jit.save(frozen, buffer)
+            self.unoptimized = buffer.getvalue()
+            frozen = torch.jit.optimize_for_inference(frozen)
+        self.frozen = frozen
+
+
+    # Returns the TorchScript serialization of the frozen model, from before its optimization if it was optimized.
+    def serialized_frozen(self):
+        if self.unoptimized is not None:
+            return self.unoptimized
+        buffer = io.BytesIO()
+        torch.jit.save(self.frozen, buffer)
+        return buffer.getvalue()
+
+
+    # Builds an int8 model of the current weights for CPU inference and predicts with it until they change,
+    # like freeze. "dynamic" stores the weights of the linear layers (the policy and value heads) in int8 and
+    # quantizes their inputs on the fly. "static" quantizes the convolutions too, with activation ranges
+    # observed while evaluating calibration_states, which should look like the positions the model will see
+    # (e.g. a sample of the replay buffer). Weights stay float in the trainable model.
+    def quantize(self, mode="dynamic", calibration_states=None):
+        if self.cuda:
+            raise ValueError("Quantized models only run on the CPU")
+        model = copy.deepcopy(self.model).eval()
+        if mode == "dynamic":
+            model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif mode == "static":
+            if calibration_states is None or len(calibration_states) == 0:
+                raise ValueError("Static quantization needs calibration states")
+            example = torch.from_numpy(np.stack([self.game.get_tensor(calibration_states[0])]))
+            model = prepare_fx(model, get_default_qconfig_mapping(torch.backends.quantized.engine), (example,))
+            with torch.no_grad():
+                for start in range(0, len(calibration_states), self.batch_size):
+                    batch = calibration_states[start:start+self.batch_size]
+                    model(torch.from_numpy(np.stack([self.game.get_tensor(s) for s in batch])))
+            model = convert_fx(model)
+        else:
+            raise ValueError("Unknown quantization mode {}, expected dynamic or static".format(mode))
+        self.set_frozen(self.trace(model))
+        return self.frozen
+
+
+    # Traces model in eval mode on a batch of initial states and freezes the result.
+    def trace(self, model):
+        model.eval()
+        initial_state = self.game.get_initial_state()[0]
+        example = torch.from_numpy(np.stack([self.game.get_tensor(initial_state)]*2))
+        if self.cuda:
+            example = example.cuda()
         with torch.no_grad():
-            input_s = torch.from_numpy(input_s)
-            p_logits, v = self.model(input_s)
-            p, v = self.get_valid_dist(s, p_logits[0]).cpu().numpy().squeeze(), v.cpu().numpy().reshape(-1)[0] # EXP because log softmax
-        return p, v
+            return torch.jit.freeze(torch.jit.trace(model, example))
+
+
+    # Returns the hit and miss counters and the occupancy of the evaluation cache.
+    def cache_info(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": len(self.cache), "max_size": self.cache_size,
+            "hit_rate": self.cache_hits/max(self.cache_hits+self.cache_misses, 1), "version": self.version}
 
 
     # MSE + Cross entropy
-    def loss(self, states, prediction, target):
-        batch_size = len(states)
+    # masks are the (N, num_actions) legal move masks of the batch, and the policy targets distributions over
+    # each state's legal moves (ordered by flat action index). The log-softmax is masked like in evaluate_batch.
+    def loss(self, masks, prediction, target):
         p_pred, v_pred = prediction
         p_gt, v_gt = target
         v_loss = ((v_pred - v_gt)**2).sum()
-        p_loss = 0
-        for i in range(batch_size):
-            gt = torch.from_numpy(p_gt[i].astype(np.float32))
-            if self.cuda:
-                gt = gt.cuda()
-            s = states[i]
-            logits = p_pred[i]
-            pred = self.get_valid_dist(s, logits, log_softmax=True)
-            p_loss += -torch.sum(gt*pred)            
+        gt = np.zeros(masks.shape, dtype=np.float32)
+        gt[masks] = np.concatenate(p_gt)
+        gt, legal = torch.from_numpy(gt), torch.from_numpy(masks)
+        if self.cuda:
+            gt, legal = gt.cuda(), legal.cuda()
+        p_logits = p_pred.reshape(len(masks), -1).masked_fill(~legal, -np.inf)
+        pred = torch.nn.functional.log_softmax(p_logits, dim=1).masked_fill(~legal, 0)
+        p_loss = -torch.sum(gt*pred)
         return p_loss + v_loss
 
 
     # Takes one state and logit set as input, produces a softmax/log_softmax over the valid actions.
+    # The distribution is ordered by flat action index, matching get_available_action_indices.
     def get_valid_dist(self, s, logits, log_softmax=False):
-        mask = torch.from_numpy(self.game.get_available_actions(s).astype(np.uint8))
+        idx = torch.from_numpy(self.game.get_available_action_indices(s).astype(np.int64))
         if self.cuda:
-            mask = mask.cuda()
-        selection = torch.masked_select(logits, mask)
+            idx = idx.cuda()
+        selection = logits.reshape(-1)[idx]
         dist = torch.nn.functional.log_softmax(selection, dim=-1)
         if log_softmax:
             return dist
         return torch.exp(dist)
 
 
+    # Name of the game used in checkpoint paths.
+    # Alternate backends subclass the game they implement (e.g. BitboardMiniChess is a MiniChess),
+    # so they share its checkpoints.
+    def game_name(self):
+        game_class = self.game.__class__
+        while Game not in game_class.__bases__:
+            game_class = game_class.__bases__[0]
+        return game_class.__name__
+
+
     # Saves the current network along with its current pool of training data and training error history.
     # Provide the name of the save file.
     def save(self, name, training_data, error_log):
         network_name = self.model.module.__class__.__name__ if self.cuda else self.model.__class__.__name__
-        directory = "checkpoints/{}-{}".format(self.game.__class__.__name__, network_name)
+        directory = "checkpoints/{}-{}".format(self.game_name(), network_name)
         if not os.path.exists(directory):
             os.makedirs(directory)
         network_path = "{}/{}.ckpt".format(directory, name)
@@ -103,21 +316,52 @@ class NeuralNetwork():
     # Optionally, also load and return the training data and training error history.
     def load(self, name, load_supplementary_data=False):
         network_name = self.model.module.__class__.__name__ if self.cuda else self.model.__class__.__name__
-        directory = "checkpoints/{}-{}".format(self.game.__class__.__name__, network_name)
+        directory = "checkpoints/{}-{}".format(self.game_name(), network_name)
         network_path = "{}/{}.ckpt".format(directory, name)
         network_checkpoint = torch.load(network_path)
+        self.weights_changed()
         self.model.load_state_dict(network_checkpoint['model_state_dict'])
         self.optimizer.load_state_dict(network_checkpoint['optimizer_state_dict'])
         if load_supplementary_data:
             data_path = "{}/training.data".format(directory)
-            data_checkpoint = torch.load(data_path)
-            return data_checkpoint['training_data'], network_checkpoint['error_log']
+            data_checkpoint = torch.load(data_path, weights_only=False) # holds numpy object arrays
+            training_data = data_checkpoint['training_data']
+            # Older checkpoints stored full state tensors, encode them like new samples.
+            if len(training_data) > 0 and isinstance(training_data[0,0], np.ndarray):
+                training_data[:,0] = [self.game.encode(self.game.from_tensor(s)) for s in training_data[:,0]]
+            return training_data, network_checkpoint['error_log']
+
+
+    # Saves the TorchScript model predictions run on (freezing the current weights first if there is none,
+    # see freeze and quantize) next to the checkpoints, as <name>.pt, and returns its path.
+    # load_frozen reads it back into a NeuralNetwork of the same game and model class; the checkpoint itself
+    # (weights and optimizer state) is not needed.
+    def export(self, name):
+        network_name = self.model.module.__class__.__name__ if self.cuda else self.model.__class__.__name__
+        directory = "checkpoints/{}-{}".format(self.game_name(), network_name)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if self.frozen is None:
+            self.freeze()
+        path = "{}/{}.pt".format(directory, name)
+        with open(path, "wb") as f:
+            f.write(self.serialized_frozen())
+        return path
+
+
+    # Loads the exported model at the given name and predicts with it, see freeze and quantize.
+    # The trainable model keeps its weights, so training or loading a checkpoint goes back to it.
+    def load_frozen(self, name, optimize=False):
+        network_name = self.model.module.__class__.__name__ if self.cuda else self.model.__class__.__name__
+        directory = "checkpoints/{}-{}".format(self.game_name(), network_name)
+        frozen = torch.jit.load("{}/{}.pt".format(directory, name), map_location="cuda" if self.cuda else "cpu")
+        self.set_frozen(frozen, optimize)
 
 
     # Utility function for listing all available model checkpoints.
     def list_checkpoints(self):
         network_name = self.model.module.__class__.__name__ if self.cuda else self.model.__class__.__name__
-        path = "checkpoints/{}-{}/".format(self.game.__class__.__name__, network_name)
+        path = "checkpoints/{}-{}/".format(self.game_name(), network_name)
         if  not os.path.isdir(path):
             return []
         return sorted([filename.split(".ckpt")[0] for filename in os.listdir(path) if filename.endswith(".ckpt")], key=lambda s: int(s))
@@ -0,0 +1,351 @@
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import traceback
+import numpy as np
+import torch
+from multiprocessing import shared_memory
+from mcts import MCTS, NodePool, UNPROVEN
+
+# Tree-parallel MCTS: several worker processes run simulations from the same root at once, all
+# reading and updating one node table in shared memory.
+#
+# Each worker holds its own copy of the game and the network, so leaf evaluations run truly in
+# parallel. Selection reads the shared statistics without locking (the child links it caches are the
+# same whichever worker writes them first). Virtual losses, backups and expansions take one lock
+# shared by all workers, which is held only for a few array writes, while the network evaluations
+# that dominate a simulation happen outside it. Virtual loss steers the workers down different
+# paths, as in the batched search of MCTS.
+#
+# The node table has a fixed capacity. Once it is full, leaves are still evaluated and backed up but
+# no longer added to the tree.
+
+
+# Sizes of the arrays of a SharedNodePool, in the order they are laid out in shared memory.
+def pool_layout(node_capacity, edge_capacity, table_capacity):
+    return [
+        ("first", np.int32, node_capacity), ("num", np.int16, node_capacity),
+        ("visits", np.int32, node_capacity), ("players", np.int8, node_capacity),
+        ("results", np.int16, node_capacity), ("values", np.float32, node_capacity),
+        ("codes", np.uint8, (node_capacity, 26)), ("node_keys", np.uint64, node_capacity),
+        ("actions", np.int16, edge_capacity), ("N", np.int32, edge_capacity),
+        ("W", np.float32, edge_capacity), ("P", np.float32, edge_capacity),
+        ("children", np.int32, edge_capacity), ("irreversible", np.bool_, edge_capacity),
+        ("proofs", np.int16, edge_capacity),
+        ("table_keys", np.uint64, table_capacity), ("table_nodes", np.int32, table_capacity),
+        ("counters", np.int64, 2),
+    ]
+
+
+# NodePool whose arrays live in one shared memory block, so that every process attached to it
+# sees the same tree. States are stored as their compact encodings and keys as 64-bit integers.
+# The state hash -> node id dictionary of MCTS is replaced by an open-addressing hash table
+# (table_keys, table_nodes) in the same block, see lookup and insert.
+class SharedNodePool(NodePool):
+
+    # Creates a new block if name is None, otherwise attaches to the existing block called name.
+    def __init__(self, game, node_capacity, edge_capacity, name=None):
+        self.game = game
+        self.node_capacity, self.edge_capacity = node_capacity, edge_capacity
+        self.min_node_capacity, self.min_edge_capacity = node_capacity, edge_capacity
+        self.table_capacity = 1 << (2*node_capacity-1).bit_length() # at most half full
+        layout = pool_layout(node_capacity, edge_capacity, self.table_capacity)
+        size = sum(np.dtype(dtype).itemsize*int(np.prod(shape)) + 8 for _, dtype, shape in layout)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name) # the creator unlinks it
+        offset = 0
+        for field, dtype, shape in layout:
+            array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            setattr(self, field, array)
+            offset += array.nbytes + (-array.nbytes) % 8
+        self.keys = SharedKeys(self)
+        self.states = SharedStates(self)
+        if name is None:
+            self.reset()
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def num_nodes(self):
+        return int(self.counters[0])
+
+    @property
+    def num_edges(self):
+        return int(self.counters[1])
+
+    # Empties the tree.
+    def reset(self):
+        self.counters[:] = 0
+        self.table_nodes[:] = -1
+
+    # Returns whether a node with num_actions edges still fits.
+    def has_room(self, num_actions):
+        return self.num_nodes < self.node_capacity and self.num_edges+num_actions <= self.edge_capacity
+
+    # Same as NodePool.add, but the arrays never grow; check has_room first. Callers hold the tree lock.
+    def add(self, key, s, player, actions, priors, value):
+        node, start = self.num_nodes, self.num_edges
+        end = start+len(actions)
+        self.first[node], self.num[node], self.visits[node], self.players[node] = start, len(actions), 0, player
+        self.results[node] = UNPROVEN
+        self.values[node] = value
+        self.codes[node] = np.frombuffer(self.game.encode(s), dtype=np.uint8)
+        self.node_keys[node] = key
+        self.actions[start:end] = actions
+        self.N[start:end] = 0
+        self.W[start:end] = 0
+        self.P[start:end] = priors
+        self.children[start:end] = -1
+        self.irreversible[start:end] = False
+        self.proofs[start:end] = UNPROVEN
+        self.counters[:] = node+1, end
+        return node
+
+    # Returns the table slot where key is stored, or the empty slot where it would go.
+    def slot(self, key):
+        mask = self.table_capacity-1
+        slot = (key*0x9E3779B97F4A7C15 >> 32) & mask # spread keys whose low bits are alike
+        while self.table_nodes[slot] >= 0 and int(self.table_keys[slot]) != key:
+            slot = (slot+1) & mask
+        return slot
+
+    def lookup(self, key):
+        node = int(self.table_nodes[self.slot(key)])
+        return None if node < 0 else node
+
+    # Records the node id of key. Callers hold the tree lock.
+    def insert(self, key, node):
+        slot = self.slot(key)
+        self.table_keys[slot] = key
+        self.table_nodes[slot] = node
+
+    def compact(self, keep):
+        raise NotImplementedError("SharedNodePool has a fixed layout and cannot be compacted")
+
+    def nbytes(self):
+        return self.shm.size
+
+    # Detaches from the block, and frees it if unlink is set (by the process that created it).
+    def close(self, unlink=False):
+        for field, _, _ in pool_layout(0, 0, 0):
+            setattr(self, field, None) # drop the views so the buffer can be released
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+# Sequence views of the per-node keys and states of a SharedNodePool, matching NodePool.keys and NodePool.states.
+class SharedKeys:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getitem__(self, node):
+        return int(self.pool.node_keys[node])
+
+
+class SharedStates:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getitem__(self, node):
+        return self.pool.game.decode(self.pool.codes[node].tobytes(), int(self.pool.node_keys[node]))
+
+
+# The dictionary interface MCTS uses for its state hash -> node id map, backed by the pool's hash table.
+class SharedNodes:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def get(self, key, default=None):
+        node = self.pool.lookup(key)
+        return default if node is None else node
+
+    def __getitem__(self, key):
+        node = self.pool.lookup(key)
+        if node is None:
+            raise KeyError(key)
+        return node
+
+    def __setitem__(self, key, node):
+        self.pool.insert(key, node)
+
+
+# The MCTS run by each worker process over the shared tree.
+# Every write to the shared statistics happens under the tree lock.
+class SharedTreeWorker(MCTS):
+
+    def __init__(self, game, nn, pool, lock):
+        MCTS.__init__(self, game, nn)
+        self.pool = pool
+        self.nodes = SharedNodes(pool)
+        self.lock = lock
+        self.peers = 1 # workers taking part in the current search
+
+    def peer_factor(self):
+        return self.peers
+
+    def apply_virtual_loss(self, node, edge, virtual_loss):
+        with self.lock:
+            MCTS.apply_virtual_loss(self, node, edge, virtual_loss)
+
+    def backup(self, path, v, winning_player, virtual_loss=0, count=True):
+        with self.lock:
+            MCTS.backup(self, path, v, winning_player, virtual_loss, count)
+
+    def prove(self, path, proof):
+        with self.lock:
+            MCTS.prove(self, path, proof)
+
+    # Another worker may have expanded the same state while this one was evaluating it,
+    # in which case its node is reused and this evaluation only counts as a visit.
+    def expand(self, s, hashed_s, p, v, path):
+        current_player = self.game.get_player(s)
+        idx = self.game.get_available_action_indices(s)
+        with self.lock:
+            node = self.nodes.get(hashed_s)
+            if node is None and self.pool.has_room(len(idx)):
+                node = self.pool.add(hashed_s, s, current_player, idx, p, v)
+                self.nodes[hashed_s] = node
+            if node is not None and len(path) > 0:
+                self.pool.children[path[-1][1]] = node
+        return current_player
+
+
+# Entry point of a worker process: reports when it is ready, then runs the searches it is sent until it receives None.
+def worker_loop(game, nn, pool_spec, lock, tasks, results):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # interrupts are handled by the parent, which stops the workers
+    torch.set_num_threads(1) # one core per worker
+    try:
+        pool = SharedNodePool(game, *pool_spec)
+        worker = SharedTreeWorker(game, nn, pool, lock)
+        results.put(None) # ready
+    except Exception:
+        results.put(traceback.format_exc())
+        return
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        code, state_map, num_simulations, cpuct, batch_size, virtual_loss, deadline, early_stop, peers = task
+        worker.peers = peers
+        try:
+            time_limit = None if deadline is None else max(deadline-time.time(), 0)
+            results.put(worker.search_batched(game.decode(code), state_map, num_simulations, cpuct, batch_size, virtual_loss, time_limit, early_stop))
+        except Exception:
+            results.put(traceback.format_exc())
+    pool.close()
+
+
+# MCTS whose searches are split across num_workers processes sharing one tree.
+# The game must hash states to 64-bit integers (e.g. BitboardMiniChess). Workers copy the network
+# when they start, so create a new ParallelMCTS (or call close and recreate it) after training.
+# The tree holds at most max_nodes nodes (default 50000) with max_edges edges (default 16 per node).
+# Call close when done to stop the workers and free the shared memory.
+class ParallelMCTS(MCTS):
+
+    def __init__(self, game, nn, num_workers=None, max_nodes=None, max_edges=None):
+        MCTS.__init__(self, game, nn)
+        key = game.get_hash(game.get_initial_state()[0])
+        if not isinstance(key, int) or key < 0 or key >= 1 << 64:
+            raise ValueError("ParallelMCTS needs a game whose get_hash returns 64-bit integers, such as BitboardMiniChess")
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        max_nodes = max_nodes if max_nodes is not None else 50000
+        max_edges = max_edges if max_edges is not None else 16*max_nodes
+        self.pool = SharedNodePool(game, max_nodes, max_edges)
+        self.nodes = SharedNodes(self.pool)
+        context = multiprocessing.get_context("spawn")
+        self.lock = context.Lock()
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.workers = [context.Process(target=worker_loop, daemon=True,
+            args=(game, nn, (max_nodes, max_edges, self.pool.name), self.lock, self.tasks, self.results))
+            for _ in range(self.num_workers)]
+        for worker in self.workers:
+            worker.start()
+        try:
+            errors = self.collect(len(self.workers)) # wait until every worker is ready to search
+        except RuntimeError as error:
+            self.close()
+            raise RuntimeError("MCTS worker failed to start: {}".format(error))
+        errors = [error for error in errors if error is not None]
+        if len(errors) > 0:
+            self.close()
+            raise RuntimeError("MCTS worker failed to start:\n" + errors[0])
+        self.local = SharedTreeWorker(game, nn, self.pool, self.lock)
+
+    # Waits for count results from the workers. Raises RuntimeError if a worker exits without sending
+    # its result (e.g. killed, or crashed while unpickling the network), which would otherwise block forever.
+    def collect(self, count, poll_interval=1.):
+        results = []
+        while len(results) < count:
+            try:
+                results.append(self.results.get(timeout=poll_interval))
+            except queue.Empty:
+                dead = [worker for worker in self.workers if not worker.is_alive()]
+                if len(dead) > 0:
+                    raise RuntimeError("MCTS worker {} exited with code {}".format(dead[0].pid, dead[0].exitcode))
+        return results
+
+    # A single simulation is run in this process, on the shared tree, so that its result can be returned.
+    def simulate(self, s, state_map, cpuct=1, epsilon_fix=True):
+        self.root = self.np_hash(s)
+        return self.local.simulate(s, state_map, cpuct, epsilon_fix)
+
+    # Splits num_simulations between the workers and waits for all of them. Returns the total simulations run.
+    # batch_size is the number of leaves each worker evaluates per forward pass. Under a time limit every
+    # worker searches until the shared deadline, see MCTS.search.
+    def search(self, s, state_map, num_simulations, cpuct=1, batch_size=1, virtual_loss=1, time_limit=None, early_stop=False):
+        self.simulation_limit(num_simulations, time_limit)
+        self.root = self.np_hash(s)
+        code = self.game.encode(s)
+        deadline = None if time_limit is None else time.time()+time_limit
+        if num_simulations is None:
+            shares = [None]*self.num_workers
+        else:
+            shares = [num_simulations//self.num_workers + (k < num_simulations % self.num_workers) for k in range(self.num_workers)]
+            shares = [share for share in shares if share > 0]
+        for share in shares:
+            self.tasks.put((code, state_map, share, cpuct, batch_size, virtual_loss, deadline, early_stop, len(shares)))
+        results = self.collect(len(shares))
+        errors = [result for result in results if isinstance(result, str)]
+        if len(errors) > 0:
+            raise RuntimeError("MCTS worker failed:\n" + errors[0])
+        return sum(results)
+
+    # The shared tree cannot be compacted while workers hold views into it, so instead of pruning,
+    # the whole tree is kept (the new root's statistics are found by hash) until it is half full.
+    def advance_root(self, action):
+        if self.pool.num_nodes > self.pool.node_capacity//2:
+            self.clear()
+
+    def reroot(self, s):
+        self.advance_root(None)
+
+    def clear(self):
+        with self.lock:
+            self.pool.reset()
+        self.root = None
+
+    def enforce_budget(self):
+        pass
+
+    def memory_info(self):
+        return {"nodes": self.pool.num_nodes, "peak_nodes": self.pool.num_nodes, "max_nodes": self.pool.node_capacity,
+            "evictions": 0, "evicted_nodes": 0, "bytes": self.pool.nbytes()}
+
+    # Stops the workers and frees the shared tree.
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.pool.close(unlink=True)
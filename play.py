@@ -5,7 +5,8 @@ import time
 # Returns a dictionary of points. It will map each player object to its score.
 # For each match, a player gains a point if it wins, loses a point if it loses,
 # and gains no points if it ties.
-def play_match(game, players, verbose=False, permute=False):
+# Games start from the initial state, or from the (state, state_map) pair start.
+def play_match(game, players, verbose=False, permute=False, start=None):
 
     # You can use permutations to break the dependence on player order in measuring strength.
     matches = list(permutations(players)) if permute else [players]
@@ -18,7 +19,7 @@ def play_match(game, players, verbose=False, permute=False):
 
     # Run the matches (there will be multiple if permute=True)
     for m in matches:
-        s, state_map = game.get_initial_state()
+        s, state_map = game.get_initial_state() if start is None else start
         if verbose: game.visualize(s)
         winner = game.check_winner(s, state_map)
         while winner is None:
@@ -63,8 +64,11 @@ if __name__ == "__main__":
     # Change these variable 
     game = MiniChess()
     ckpt = 190
+    quantized = None # "dynamic" or "static" to play on the int8 model written by quantize.py
     nn = NeuralNetwork(game, Zero, cuda=False)
     nn.load(ckpt)
+    if quantized is not None:
+        nn.load_frozen("{}-int8-{}".format(ckpt, quantized))
     
     human =  HumanMinichessPlayer(game)
     uninformed = UninformedMCTSPlayer(game, simulations=80)
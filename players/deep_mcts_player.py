@@ -1,47 +1,83 @@
 import sys
+import time
 import numpy as np
 sys.path.append("..")
-from mcts import MCTS
+from mcts import MCTS, SearchStats
+from parallel_mcts import ParallelMCTS
 from player import Player
 
+# Runs the search of a player from state s within its simulation and time budgets and records what it achieved.
+def timed_search(player, s, state_map):
+    time_limit = None if player.move_time is None else player.move_time/1000
+    start = time.time()
+    simulations = player.tree.search(s, state_map, player.simulations, batch_size=player.batch_size,
+        time_limit=time_limit, early_stop=player.early_stop)
+    player.last_search = {"simulations": simulations, "elapsed": time.time()-start}
+
 class DeepMCTSPlayer(Player):
 
-    def __init__(self, game, nn, simulations):
+    # With workers > 1, searches run on a ParallelMCTS with that many processes; call close when done.
+    # move_time optionally limits each search to that many milliseconds (simulations can then be None for
+    # no cap), and early_stop ends a search once its move is decided, see MCTS.search.
+    # The simulations run and the seconds spent on the last move are kept in last_search.
+    # With stats, the searches of every game (single-process only) are added up in a SearchStats.
+    # nn may predict on an exported model, see NeuralNetwork.load_frozen.
+    def __init__(self, game, nn, simulations, batch_size=1, max_nodes=None, workers=1, move_time=None, early_stop=True, stats=False):
         self.game = game
         self.simulations = simulations
+        self.batch_size = batch_size # leaves evaluated together, see MCTS.search
+        self.max_nodes = max_nodes # tree size budget, see MCTS.evict
+        self.move_time = move_time
+        self.early_stop = early_stop
+        self.last_search = None
+        self.stats = SearchStats() if stats else None
         self.nn = nn
-        self.tree = MCTS(game, nn)
+        if workers > 1:
+            self.tree = ParallelMCTS(game, nn, num_workers=workers, max_nodes=max_nodes)
+        else:
+            self.tree = MCTS(game, nn, max_nodes=max_nodes, stats=self.stats)
 
     def update_state(self, s, state_map):
-        for _ in range(self.simulations):
-            self.tree.simulate(s, state_map)
+        self.tree.reroot(s) # continue from the subtree of the move the opponent played
+        timed_search(self, s, state_map)
 
         dist = self.tree.get_distribution(s, 0)
-        a = tuple(dist[np.argmax(dist[:,1]),0])
-        available = self.game.get_available_actions(s)
-        template = np.zeros_like(available)
-        template[a] = 1
-        s_prime, state_map_prime = self.game.take_action(s, state_map, template)
+        a = dist[np.argmax(dist[:,1]),0]
+        self.tree.advance_root(a)
+        s_prime, state_map_prime = self.game.take_action_index(s, state_map, a)
         return s_prime, state_map_prime
 
     def reset(self):
-        self.tree = MCTS(self.game, self.nn)
+        if isinstance(self.tree, ParallelMCTS):
+            self.tree.clear() # keeps the worker processes running
+        else:
+            self.tree = MCTS(self.game, self.nn, max_nodes=self.max_nodes, stats=self.stats)
+
+    # Stops the worker processes of a parallel search.
+    def close(self):
+        if isinstance(self.tree, ParallelMCTS):
+            self.tree.close()
 
 class DeepMCTSPlayerAction(Player):
 
-    def __init__(self, game, nn, simulations):
+    def __init__(self, game, nn, simulations, batch_size=1, max_nodes=None, move_time=None, early_stop=True, stats=False):
         self.game = game
         self.simulations = simulations
+        self.batch_size = batch_size # leaves evaluated together, see MCTS.search
+        self.max_nodes = max_nodes # tree size budget, see MCTS.evict
+        self.move_time = move_time
+        self.early_stop = early_stop
+        self.last_search = None
+        self.stats = SearchStats() if stats else None
         self.nn = nn
-        self.tree = MCTS(game, nn)
+        self.tree = MCTS(game, nn, max_nodes=max_nodes, stats=self.stats)
 
     def update_state(self, s, state_map):
-        for _ in range(self.simulations):
-            self.tree.simulate(s, state_map)
+        timed_search(self, s, state_map)
 
         dist = self.tree.get_distribution(s, 0)
-        a = tuple(dist[np.argmax(dist[:,1]),0])
-        return a
+        a = dist[np.argmax(dist[:,1]),0]
+        return np.unravel_index(a, self.game.get_available_actions(s).shape)
 
     def reset(self):
-        self.tree = MCTS(self.game, self.nn)
+        self.tree = MCTS(self.game, self.nn, max_nodes=self.max_nodes, stats=self.stats)
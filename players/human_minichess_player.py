@@ -17,15 +17,13 @@ class HumanMinichessPlayer(Player):
                             Styles.PADDING_SMALL, Styles.PADDING_SMALL,
                             Colors.RESET))
                 a = (5-int(a[1]), ord(a[0])-ord('a'), 5-int(a[3]), ord(a[2])-ord('a'))
-                available = self.game.get_available_actions(s)
-                template = np.zeros_like(available)
-                template[a] = 1
-                if available[template] == 1:
+                a = np.ravel_multi_index(a, (5, 5, 5, 5))
+                if a in self.game.get_available_action_indices(s):
                     break
             except (ValueError, IndexError):
                 pass
             print("Invalid move! Try again.")
-        s_prime, state_map_prime = self.game.take_action(s, state_map, template)
+        s_prime, state_map_prime = self.game.take_action_index(s, state_map, a)
         return s_prime, state_map_prime
 
     def reset(self):
@@ -13,15 +13,13 @@ class HumanPlayer(Player):
             try:
                 a = input()
                 a = tuple([int(x) for x in a.split(" ")])
-                available = self.game.get_available_actions(s)
-                template = np.zeros_like(available)
-                template[a] = 1
-                if available[template] == 1:
+                a = np.ravel_multi_index(a, self.game.get_available_actions(s).shape)
+                if a in self.game.get_available_action_indices(s):
                     break
             except (ValueError, IndexError):
                 pass
             print("Invalid move! Try again.")
-        s_prime, state_map_prime = self.game.take_action(s, state_map, template)
+        s_prime, state_map_prime = self.game.take_action_index(s, state_map, a)
         return s_prime, state_map_prime
 
     def reset(self):
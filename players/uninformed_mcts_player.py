@@ -18,11 +18,8 @@ class UninformedMCTSPlayer(Player):
             self.tree.simulate(s, state_map)
 
         dist = self.tree.get_distribution(s, 0)
-        a = tuple(dist[np.argmax(dist[:,1]),0])
-        available = self.game.get_available_actions(s)
-        template = np.zeros_like(available)
-        template[a] = 1
-        s_prime, state_map_prime = self.game.take_action(s, state_map, template)
+        a = dist[np.argmax(dist[:,1]),0]
+        s_prime, state_map_prime = self.game.take_action_index(s, state_map, a)
         return s_prime, state_map_prime
 
     def reset(self):
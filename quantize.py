@@ -0,0 +1,117 @@
+import argparse
+import json
+import random
+import sys
+import time
+import numpy as np
+from models.zero import Zero
+from games.minichess import MiniChess
+from games.bitboard_minichess import BitboardMiniChess
+from neural_network import NeuralNetwork
+from play import play_match
+from players.deep_mcts_player import DeepMCTSPlayer
+
+# Produces an int8 version of a checkpoint (see NeuralNetwork.quantize) and a report of how far it strays
+# from the float model, to decide whether its speedup is safe to use for self-play and play.
+#
+# Positions are sampled from the checkpoint's replay buffer: one part calibrates static quantization, a
+# disjoint part measures the mean and worst policy KL divergence (float || int8, over legal moves) and value
+# error. Both models then play a head-to-head match from random openings, each opening once with either
+# color. The int8 model is exported as <checkpoint>-int8-<mode>.pt next to the checkpoint, for
+# NeuralNetwork.load_frozen, and the report is written beside it as JSON.
+
+
+# Returns the mean and maximum policy KL divergence and value error of candidate against reference.
+def compare_predictions(reference, candidate, states):
+    p_ref, v_ref = reference.predict_batch(states, padded=True)
+    p_new, v_new = candidate.predict_batch(states, padded=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = np.where(p_ref > 0, p_ref*(np.log(p_ref)-np.log(p_new)), 0.)
+    kl = terms.sum(axis=1)
+    errors = np.abs(v_ref-v_new)
+    return {"policy_kl_mean": float(kl.mean()), "policy_kl_max": float(kl.max()),
+        "value_error_mean": float(errors.mean()), "value_error_max": float(errors.max()),
+        "top_move_agreement": float((p_ref.argmax(axis=1) == p_new.argmax(axis=1)).mean())}
+
+
+# Returns milliseconds per predict call on one position and positions per second of predict_batch on states.
+def prediction_speed(nn, states, min_time=1.):
+    timings = []
+    for batch in [states[:1], states]:
+        nn.predict_batch(batch)
+        count, start = 0, time.time()
+        while time.time()-start < min_time:
+            nn.predict_batch(batch)
+            count += 1
+        timings.append((time.time()-start)/count)
+    return {"ms_per_call": 1000*timings[0], "batch_positions_per_sec": len(states)/timings[1]}
+
+
+# Plays num_openings pairs of games between the two networks from openings of opening_plies random moves,
+# swapping colors within each pair. Returns the candidate's score (1 per win, 0.5 per draw) over all games.
+def head_to_head(game, reference, candidate, num_openings, simulations, opening_plies=4, seed=0):
+    rng = random.Random(seed)
+    score = 0
+    for _ in range(num_openings):
+        s, state_map = game.get_initial_state()
+        for _ in range(opening_plies):
+            if game.check_winner(s, state_map) is not None:
+                break
+            s, state_map = game.take_action_index(s, state_map, rng.choice(list(game.get_available_action_indices(s))))
+        players = [DeepMCTSPlayer(game, reference, simulations), DeepMCTSPlayer(game, candidate, simulations)]
+        scores, _ = play_match(game, players, permute=True, start=(s, state_map))
+        score += scores[players[1]]
+    return score/num_openings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", help="run configuration of the checkpoint, e.g. configs/minichess-cpu.json")
+    parser.add_argument("checkpoint", help="checkpoint name, e.g. 320")
+    parser.add_argument("--mode", choices=["dynamic", "static"], default="dynamic")
+    parser.add_argument("--calibration", help="replay buffer positions used to calibrate static quantization", type=int, default=1024)
+    parser.add_argument("--positions", help="replay buffer positions the predictions are compared on", type=int, default=1024)
+    parser.add_argument("--openings", help="random openings of the head-to-head match, each played with both colors", type=int, default=10)
+    parser.add_argument("--simulations", help="MCTS simulations per move in the match", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = json.loads(f.read())
+    game = globals()[config["game"]]()
+    model_class = globals()[config["model"]]
+    reference = NeuralNetwork(game, model_class)
+    training_data, _ = reference.load(args.checkpoint, load_supplementary_data=True)
+    if len(training_data) == 0:
+        print("Checkpoint {} has an empty replay buffer to sample positions from.".format(args.checkpoint))
+        sys.exit(1)
+    codes = training_data[np.random.RandomState(args.seed).permutation(len(training_data)), 0]
+    calibration_states = [game.decode(code) for code in codes[:args.calibration]]
+    states = [game.decode(code) for code in codes[args.calibration:args.calibration+args.positions]]
+    if len(states) == 0: # small buffer: measure on the calibration positions
+        states = calibration_states
+
+    candidate = NeuralNetwork(game, model_class)
+    candidate.load(args.checkpoint)
+    candidate.quantize(args.mode, calibration_states)
+    path = candidate.export("{}-int8-{}".format(args.checkpoint, args.mode))
+    report = {"checkpoint": args.checkpoint, "mode": args.mode, "calibration_positions": len(calibration_states),
+        "positions": len(states)}
+    report.update(compare_predictions(reference, candidate, states))
+    speeds = {"fp32": prediction_speed(reference, states[:64]), "int8": prediction_speed(candidate, states[:64])}
+    report["speed"] = speeds
+    report["speedup"] = speeds["int8"]["batch_positions_per_sec"]/speeds["fp32"]["batch_positions_per_sec"]
+    report["match_games"] = 2*args.openings
+    report["match_score"] = head_to_head(game, reference, candidate, args.openings, args.simulations, seed=args.seed)
+    with open(path[:-len(".pt")]+".json", "w") as f:
+        json.dump(report, f, indent=4)
+
+    print("Exported {}".format(path))
+    print("Policy KL divergence: mean {:.5f}, max {:.5f}; top move agreement {:.1%}".format(
+        report["policy_kl_mean"], report["policy_kl_max"], report["top_move_agreement"]))
+    print("Value error: mean {:.5f}, max {:.5f}".format(report["value_error_mean"], report["value_error_max"]))
+    for name, speed in speeds.items():
+        print("{}: {:.3f} ms/call, {:.0f} positions/s in batches of {}".format(
+            name, speed["ms_per_call"], speed["batch_positions_per_sec"], min(len(states), 64)))
+    print("Batch speedup: {:.2f}x".format(report["speedup"]))
+    print("Match score of the int8 model: {:.3f} over {} games (0.5 is even)".format(report["match_score"], report["match_games"]))
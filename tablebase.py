@@ -0,0 +1,277 @@
+import argparse
+import itertools
+import os
+import time
+import numpy as np
+from games.bitboard_minichess import BitboardMiniChess, BitboardState
+
+# Endgame tablebases for MiniChess, solved by retrograde analysis.
+#
+# A table covers every position with one material signature: the white pieces, a "v", then the
+# black pieces, each side listed in PIECE_ORDER, e.g. "KQvK" or "KPvKP". It is stored as a flat int8
+# file <signature>.tb with one entry per position, indexed by position_index:
+#   0       draw
+#   n > 0   the player to move mates in n plies
+#   -(n+1)  the player to move is mated in n plies (-1 is checkmate on the board)
+# Entries of impossible positions (overlapping pieces, pawns on a back rank, the player who just
+# moved in check) are 0 and never probed. Repetitions are ignored, as in any tablebase.
+#
+# The rules are symmetric under swapping colors and mirroring the rows, so only one of a signature
+# and its color-flipped twin ("KQvK" and "KvKQ") is stored, and probes flip positions as needed.
+PIECE_ORDER = "KQRBNP"
+LAYERS = {letter: "PRNBQK".index(letter) for letter in PIECE_ORDER}
+LETTERS = {layer: letter for letter, layer in LAYERS.items()}
+UNRESOLVED = np.iinfo(np.int16).max
+
+
+# Returns (signature, index) of a position in the compact encoding of Game.encode.
+# Pieces are taken in signature order, pieces of the same kind by ascending square, and the index
+# is the player to move plus twice the squares read as a base-25 number, first piece lowest.
+def position_index(code):
+    squares = [[] for _ in range(12)]
+    for sq in range(25):
+        if code[sq]:
+            squares[code[sq]-1].append(sq)
+    signature = ""
+    index, base = code[25], 2
+    for color in range(2):
+        if color == 1:
+            signature += "v"
+        for letter in PIECE_ORDER:
+            for sq in squares[6*color+LAYERS[letter]]:
+                signature += letter
+                index += sq*base
+                base *= 25
+    return signature, index
+
+
+# Swaps the colors of an encoded position and mirrors it top to bottom.
+def flip_code(code):
+    flipped = bytearray(26)
+    for sq in range(25):
+        if code[sq]:
+            i, j = divmod(sq, 5)
+            flipped[5*(4-i)+j] = code[sq]+6 if code[sq] <= 6 else code[sq]-6
+    flipped[25] = 1-code[25]
+    return bytes(flipped)
+
+
+def flip_signature(signature):
+    white, black = signature.split("v")
+    return black+"v"+white
+
+
+# Returns the signature under which the table for signature is stored.
+def canonical_signature(signature):
+    return min(signature, flip_signature(signature))
+
+
+# Returns the canonical signatures reachable from signature by one capture or promotion.
+def sub_signatures(signature):
+    sides = signature.split("v")
+    result = set()
+    for side in range(2):
+        for pos, letter in enumerate(sides[side]):
+            if letter == "K":
+                continue
+            replacements = ["", "Q"] if letter == "P" else [""]
+            for replacement in replacements:
+                changed = list(sides)
+                pieces = sides[side][:pos]+replacement+sides[side][pos+1:]
+                changed[side] = "".join(sorted(pieces, key=PIECE_ORDER.index))
+                result.add(canonical_signature("v".join(changed)))
+    return sorted(result, key=len)
+
+
+def table_path(directory, signature):
+    return os.path.join(directory, signature+".tb")
+
+
+# Memory-mapped read access to the tables of a directory.
+# Tables are paged in by the operating system as positions are probed, so probing is cheap to set up
+# and can be shared by every thread of a process.
+class Tablebase:
+
+    def __init__(self, directory="tablebases"):
+        self.directory = directory
+        self.tables = {}
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".tb"):
+                    self.tables[name[:-3]] = np.memmap(os.path.join(directory, name), dtype=np.int8, mode="r")
+        self.max_pieces = max([len(signature)-1 for signature in self.tables] + [0])
+
+    # Pickles as the directory only, so other processes map the same files instead of receiving copies.
+    def __getstate__(self):
+        return {"directory": self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state["directory"])
+
+    # Returns (result, plies) for an encoded position, where result is 1 if the player to move wins,
+    # 0 for a draw and -1 for a loss, and plies is the distance to mate (0 for draws).
+    # Returns None if the position is not covered by any table.
+    def probe(self, code):
+        if 25-code[:25].count(0) > self.max_pieces:
+            return None
+        signature, index = position_index(code)
+        if signature not in self.tables:
+            signature, index = position_index(flip_code(code))
+            if signature not in self.tables:
+                return None
+        value = int(self.tables[signature][index])
+        if value > 0:
+            return 1, value
+        if value < 0:
+            return -1, -value-1
+        return 0, 0
+
+
+# Solves every position of signature and writes its table to directory, generating the tables of
+# smaller signatures it depends on first. Existing tables are kept.
+#
+# Moves are generated once per position into a successor graph; moves that capture or promote leave
+# the table and are scored from the smaller tables. Values are then propagated backwards one ply
+# at a time over the whole graph with numpy: a position is won in d plies if some move reaches a
+# position lost in d-1, and lost in d plies once every move reaches a won position, the slowest in d-1.
+def generate(game, signature, directory, verbose=True):
+    signature = canonical_signature(signature)
+    path = table_path(directory, signature)
+    if os.path.exists(path):
+        return
+    for sub in sub_signatures(signature):
+        generate(game, sub, directory, verbose)
+    start = time.time()
+    tablebase = Tablebase(directory)
+    white, black = signature.split("v")
+    layers = [LAYERS[letter] for letter in white] + [6+LAYERS[letter] for letter in black]
+    size = 2*25**len(layers)
+
+    sources, targets = [], []
+    exit_win = np.full(size, UNRESOLVED, dtype=np.int16) # fastest mate reached through a capture or promotion
+    exit_loss = np.zeros(size, dtype=np.int16) # slowest mate suffered through one
+    exit_draw = np.zeros(size, dtype=bool) # some capture or promotion holds the draw
+    has_moves = np.zeros(size, dtype=bool)
+    mated = np.zeros(size, dtype=bool)
+    for placement in itertools.product(range(25), repeat=len(layers)):
+        if len(set(placement)) < len(layers):
+            continue
+        if any(layers[k] == layers[k-1] and placement[k] < placement[k-1] for k in range(1, len(layers))):
+            continue # identical pieces are indexed in ascending square order only
+        if any(layers[k] % 6 == 0 and not 5 <= placement[k] < 20 for k in range(len(layers))):
+            continue # pawns never stand on a back rank
+        pieces = [0]*12
+        for layer, sq in zip(layers, placement):
+            pieces[layer] |= 1 << sq
+        for color in range(2):
+            s = BitboardState(tuple(pieces), color)
+            if game.in_check(1-color, s):
+                continue
+            _, index = position_index(game.encode(s))
+            moves = game.legal_moves(s)
+            if len(moves) == 0:
+                mated[index] = game.in_check(color, s)
+                continue
+            has_moves[index] = True
+            for a in moves:
+                child = game.encode(game.make_move(s, *divmod(a, 25)))
+                child_signature, child_index = position_index(child)
+                if child_signature == signature:
+                    sources.append(index)
+                    targets.append(child_index)
+                    continue
+                result, plies = tablebase.probe(child)
+                if result < 0:
+                    exit_win[index] = min(exit_win[index], plies+1)
+                elif result > 0:
+                    exit_loss[index] = max(exit_loss[index], plies+1)
+                else:
+                    exit_draw[index] = True
+    sources = np.array(sources, dtype=np.int64)
+    targets = np.array(targets, dtype=np.int64)
+    if verbose:
+        print("{}: {} positions, {} moves within the table".format(signature, has_moves.sum()+mated.sum(), len(sources)))
+
+    won = np.zeros(size, dtype=bool)
+    lost = mated.copy()
+    plies = np.zeros(size, dtype=np.int16)
+    remaining = np.bincount(sources, minlength=size) # moves not yet known to reach a won position
+    loss_plies = exit_loss.copy() # plies to mate once remaining reaches 0
+    can_lose = has_moves & ~exit_draw & (exit_win == UNRESOLVED)
+    newly_lost = mated
+    last_exit = max(int(exit_win[exit_win < UNRESOLVED].max(initial=0)), int(exit_loss.max()))
+    d = 0
+    while True:
+        d += 1
+        resolved = won | lost
+        reaches_loss = np.bincount(sources[newly_lost[targets]], minlength=size) > 0
+        newly_won = ~resolved & has_moves & (reaches_loss | (exit_win == d))
+        newly_lost = ~resolved & can_lose & (remaining == 0) & (loss_plies == d)
+        won |= newly_won
+        lost |= newly_lost
+        plies[newly_won | newly_lost] = d
+        refuted = np.bincount(sources[newly_won[targets]], minlength=size)
+        remaining -= refuted
+        exhausted = (refuted > 0) & (remaining == 0) # the last move out was refuted d plies before mate
+        loss_plies[exhausted] = np.maximum(loss_plies[exhausted], d+1)
+        if not newly_won.any() and not newly_lost.any() and d >= last_exit:
+            break
+    if plies.max() > 126:
+        raise ValueError("{}: distance to mate of {} plies does not fit in a table entry".format(signature, plies.max()))
+
+    values = np.zeros(size, dtype=np.int8)
+    values[won] = plies[won]
+    values[lost] = -plies[lost]-1
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    values.tofile(path+".tmp")
+    os.replace(path+".tmp", path)
+    if verbose:
+        print("{}: {} won, {} lost, {} drawn, longest mate {} plies ({:.1f}s)".format(signature,
+            won.sum(), lost.sum(), (has_moves & ~won & ~lost).sum(), plies.max(), time.time()-start))
+
+
+def generate_command(args):
+    game = BitboardMiniChess(cache_size=0)
+    for signature in args.signatures:
+        generate(game, signature, args.directory)
+
+
+def probe_command(args):
+    game = BitboardMiniChess(cache_size=0)
+    tablebase = Tablebase(args.directory)
+    s, _ = game.from_fen(args.fen)
+    descriptions = {1: "win in {} plies", 0: "draw", -1: "loss in {} plies"}
+    result = tablebase.probe(game.encode(s))
+    if result is None:
+        print("Position not covered by the tables in {}".format(args.directory))
+        return
+    print("{}: {}".format(args.fen, descriptions[result[0]].format(result[1])))
+    for a in game.legal_moves(s):
+        frm, to = divmod(a, 25)
+        child = game.make_move(s, frm, to)
+        child_result = tablebase.probe(game.encode(child)) if game.get_status(child).winner is None else None
+        if child_result is None: # the move ends the game on the board
+            winner = game.get_status(child).winner
+            child_result = (0, 0) if winner == -1 else (-1, 0)
+        print("  {}{}-{}{}: {}".format("abcde"[frm % 5], 5-frm//5, "abcde"[to % 5], 5-to//5,
+            descriptions[-child_result[0]].format(child_result[1]+1)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    generate_parser = subparsers.add_parser("generate", help="solve material signatures and write their tables")
+    generate_parser.add_argument("signatures", help="material signatures such as KQvK or KPvKP", nargs="+")
+    generate_parser.add_argument("--directory", default="tablebases")
+    generate_parser.set_defaults(func=generate_command)
+
+    probe_parser = subparsers.add_parser("probe", help="look up a position and each of its moves")
+    probe_parser.add_argument("fen", help='position such as "4k/5/5/5/KQ3 w"')
+    probe_parser.add_argument("--directory", default="tablebases")
+    probe_parser.set_defaults(func=probe_command)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,8 +1,10 @@
+import threading
 import time
 from tqdm import tqdm
 import numpy as np
 from multiprocessing.dummy import Pool as ThreadPool
-from mcts import MCTS
+from inference_server import InferenceServer
+from mcts import MCTS, SearchStats
 from play import play_match
 from players.uninformed_mcts_player import UninformedMCTSPlayer
 from players.deep_mcts_player import DeepMCTSPlayer
@@ -11,10 +13,40 @@ from collections import defaultdict
 # Object that coordinates AlphaZero training.
 class Trainer:
 
-    def __init__(self, game, nn, num_simulations, num_games, num_updates, buffer_size_limit, cpuct, num_threads):
+    # mcts_batch_size is the number of leaves evaluated together by each MCTS pass, see MCTS.search.
+    # mcts_max_nodes optionally bounds the tree of each self-play game, see MCTS.evict.
+    # With mcts_stats, the searches of all self-play games are instrumented and added up in search_stats.
+    # mcts_root_search is "puct" for visit count targets sampled with temperature, or "gumbel" for
+    # MCTS.gumbel_search with its improved policy targets, considering gumbel_actions moves at the root.
+    # With an inference_batch_size, the self-play threads share an InferenceServer that batches their network
+    # calls, waiting up to inference_max_wait_ms for a batch to fill; its stats are kept in inference_info.
+    # With frozen_inference, self-play evaluates on an inference-only TorchScript copy of the weights of each
+    # iteration, see NeuralNetwork.freeze. self_play_quantization ("dynamic" or "static") evaluates on an int8 copy
+    # instead, see NeuralNetwork.quantize; static quantization is calibrated on calibration_size positions
+    # sampled from the replay buffer, and self-play falls back to the frozen copy while the buffer is empty.
+    def __init__(self, game, nn, num_simulations, num_games, num_updates, buffer_size_limit, cpuct, num_threads,
+            mcts_batch_size=1, mcts_max_nodes=None, mcts_stats=False, mcts_root_search="puct", gumbel_actions=16,
+            inference_batch_size=None, inference_max_wait_ms=2, frozen_inference=False, self_play_quantization=None,
+            calibration_size=512):
+        if mcts_root_search not in ("puct", "gumbel"):
+            raise ValueError("Unknown root search {}, expected puct or gumbel".format(mcts_root_search))
         self.game = game
         self.nn = nn
         self.num_simulations = num_simulations
+        self.mcts_batch_size = mcts_batch_size
+        self.mcts_max_nodes = mcts_max_nodes
+        self.mcts_root_search = mcts_root_search
+        self.gumbel_actions = gumbel_actions
+        self.inference_batch_size = inference_batch_size
+        self.inference_max_wait_ms = inference_max_wait_ms
+        self.frozen_inference = frozen_inference
+        self.self_play_quantization = self_play_quantization
+        self.calibration_size = calibration_size
+        self.inference_info = None # stats of the inference server of the last iteration
+        self.evaluator = nn # what self-play searches call for network evaluations
+        self.mcts_info = {"peak_nodes": 0, "evictions": 0, "evicted_nodes": 0} # over all self-play games so far
+        self.search_stats = SearchStats() if mcts_stats else None # over all self-play games so far
+        self.mcts_info_lock = threading.Lock()
         self.num_games = num_games
         self.num_updates = num_updates
         self.buffer_size_limit = buffer_size_limit
@@ -27,32 +59,44 @@ class Trainer:
     # Does one game of self play and generates training samples.
     def self_play(self, temperature):
         s, state_map = self.game.get_initial_state()
-        tree = MCTS(self.game, self.nn)
+        stats = SearchStats() if self.search_stats is not None else None
+        tree = MCTS(self.game, self.evaluator, max_nodes=self.mcts_max_nodes, stats=stats)
 
         data = []
         w = None
         while w is None:
-            # Think
-            for _ in range(self.num_simulations):
-                tree.simulate(s, state_map, cpuct=self.cpuct)
+            if self.mcts_root_search == "gumbel":
+                # Think, and take the improved policy as target and the search's choice as action
+                tree.gumbel_search(s, state_map, self.num_simulations, cpuct=self.cpuct, max_considered=self.gumbel_actions)
+                dist = tree.get_improved_policy(s)
+                a = tree.gumbel_action
+            else:
+                # Think
+                tree.search(s, state_map, self.num_simulations, cpuct=self.cpuct, batch_size=self.mcts_batch_size)
 
-            # Fetch action distribution and append training example template.
-            dist = tree.get_distribution(s, temperature=temperature)
-            data.append([self.game.get_player(s), s, dist[:,1], None]) # player, state, prob, outcome
+                # Fetch action distribution, then sample an action
+                dist = tree.get_distribution(s, temperature=temperature)
+                idx = np.random.choice(len(dist), p=dist[:,1].astype(np.float))
+                a = dist[idx, 0]
 
-            # Sample an action
-            idx = np.random.choice(len(dist), p=dist[:,1].astype(np.float))
-            a = tuple(dist[idx, 0])
+            # Append training example template.
+            data.append([self.game.get_player(s), self.game.encode(s), dist[:,1].astype(np.float32), None]) # player, encoded state, prob, outcome
 
-            # Apply action
-            available = self.game.get_available_actions(s)
-            template = np.zeros_like(available)
-            template[a] = 1
-            s, state_map = self.game.take_action(s, state_map, template)
+            # Apply action, keeping the chosen subtree for the next move's search
+            tree.advance_root(a)
+            s, state_map = self.game.take_action_index(s, state_map, a)
 
             # Check winner
             w = self.game.check_winner(s, state_map)
 
+        info = tree.memory_info()
+        with self.mcts_info_lock:
+            self.mcts_info["peak_nodes"] = max(self.mcts_info["peak_nodes"], info["peak_nodes"])
+            self.mcts_info["evictions"] += info["evictions"]
+            self.mcts_info["evicted_nodes"] += info["evicted_nodes"]
+            if stats is not None:
+                self.search_stats.merge(stats)
+
         # Update training examples with outcome
         data = np.array(data)
         if w == -1:
@@ -71,12 +115,30 @@ class Trainer:
         if verbose:
             print("SIMULATING " + str(self.num_games) + " games")
             start = time.time()
+        # The frozen or quantized model is dropped again by the first training update.
+        quantization = self.self_play_quantization
+        if quantization == "static" and len(self.training_data) == 0:
+            quantization = None # nothing to calibrate on yet
+        if quantization is not None:
+            idx = np.random.randint(len(self.training_data), size=min(self.calibration_size, len(self.training_data)))
+            self.nn.quantize(quantization, [self.game.decode(code) for code in self.training_data[idx,0]])
+        elif self.frozen_inference or self.self_play_quantization is not None:
+            self.nn.freeze()
         if self.num_threads > 1:
+            if self.inference_batch_size is not None:
+                self.evaluator = InferenceServer(self.nn, max_batch_size=self.inference_batch_size,
+                    max_wait=self.inference_max_wait_ms/1000, num_clients=self.num_threads)
             jobs = [temperature]*self.num_games
             pool = ThreadPool(self.num_threads)
-            new_data = pool.map(self.self_play, jobs)
-            pool.close()
-            pool.join()
+            try:
+                new_data = pool.map(self.self_play, jobs)
+            finally:
+                pool.close()
+                pool.join()
+                if self.evaluator is not self.nn: # stop the server before training, even if a game failed
+                    self.evaluator.close()
+                    self.inference_info = self.evaluator.stats()
+                    self.evaluator = self.nn
             self.training_data = np.concatenate([self.training_data] + new_data, axis=0)
         else:
             for _ in range(self.num_games): # Self-play games
@@ -0,0 +1,40 @@
+# Persistent record of the positions reached so far in a game, used to detect repetitions.
+# Each History holds one position key and links to the History it was reached from, so recording a
+# move shares the whole past instead of copying it, and every branch of a search tree can extend
+# the same history without affecting the others.
+#
+# Lookups behave like the defaultdict(int) of position counts this replaces: history[key] is the
+# number of times key has occurred. The count for the current position is stored on the node itself.
+class History:
+    __slots__ = ("key", "count", "parent")
+
+    def __init__(self, key, parent=None, count=1):
+        self.key = key
+        self.parent = parent
+        self.count = count # occurrences of key up to and including this position
+
+    # Returns a new History with key appended; self is left untouched.
+    # An irreversible move (a capture or a pawn move) means no earlier position can ever occur again,
+    # so the chain is cut there. Otherwise, earlier positions with the same player to move are scanned
+    # back to the last irreversible move for an earlier occurrence of key.
+    def push(self, key, irreversible=False):
+        if irreversible:
+            return History(key)
+        node = self.parent
+        while node is not None:
+            if node.key == key:
+                return History(key, self, node.count+1)
+            node = node.parent
+            if node is None:
+                break
+            node = node.parent
+        return History(key, self)
+
+    def __getitem__(self, key):
+        node = self
+        while node is not None:
+            if node.key == key:
+                return node.count
+            node = node.parent
+        return 0
+